@@ -0,0 +1,83 @@
+"""Compare embedding backends on a sample corpus.
+
+Measures document embedding throughput of the PyTorch (HuggingFaceEmbeddings)
+path against ONNX Runtime in fp32 and int8, and retrieval quality as the
+overlap of each backend's top-k results with the PyTorch reference.
+
+    python benchmark_embeddings.py --corpus uploaded_docs/<session_id>
+"""
+import argparse
+import random
+import time
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from embeddings import EMBEDDING_BATCH_SIZE, EMBEDDING_THREADS, create_embeddings
+from rag_chain import load_session_documents
+
+def load_chunks(corpus_dir, limit):
+    """Split the corpus the same way build_chunk_store does."""
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, add_start_index=True)
+    splits = text_splitter.split_documents(load_session_documents(corpus_dir))
+    return [doc.page_content for doc in splits][:limit]
+
+def sample_queries(chunks, count, seed=0):
+    """Use the opening sentence of random chunks as queries."""
+    rng = random.Random(seed)
+    picked = rng.sample(chunks, min(count, len(chunks)))
+    return [chunk.split(". ")[0][:200] for chunk in picked]
+
+def time_embedding(embeddings, chunks, queries):
+    start = time.perf_counter()
+    doc_vectors = np.asarray(embeddings.embed_documents(chunks), dtype=np.float32)
+    doc_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    query_vectors = np.asarray([embeddings.embed_query(q) for q in queries], dtype=np.float32)
+    query_seconds = time.perf_counter() - start
+    return doc_vectors, query_vectors, doc_seconds, query_seconds
+
+def top_k(doc_vectors, query_vectors, k):
+    scores = query_vectors @ doc_vectors.T
+    return [set(row) for row in np.argsort(-scores, axis=1)[:, :k]]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", required=True, help="directory of documents to embed")
+    parser.add_argument("--max-chunks", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=EMBEDDING_THREADS)
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.corpus, args.max_chunks)
+    if not chunks:
+        parser.error(f"No text found in {args.corpus}")
+    queries = sample_queries(chunks, args.queries)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, k={args.k}\n")
+
+    backends = [
+        ("pytorch", create_embeddings("huggingface", batch_size=args.batch_size)),
+        ("onnx-fp32", create_embeddings("onnx", quantize=False, batch_size=args.batch_size, threads=args.threads)),
+        ("onnx-int8", create_embeddings("onnx", quantize=True, batch_size=args.batch_size, threads=args.threads)),
+    ]
+
+    print(f"{'backend':<10} {'chunks/s':>10} {'query ms':>9} {'recall@k':>9} {'cosine':>7}")
+    reference = None
+    for name, embeddings in backends:
+        # Warm up so one-time graph setup is not counted
+        embeddings.embed_documents(chunks[:args.batch_size])
+        doc_vectors, query_vectors, doc_seconds, query_seconds = time_embedding(embeddings, chunks, queries)
+        if reference is None:
+            reference = (doc_vectors, top_k(doc_vectors, query_vectors, args.k))
+        reference_vectors, reference_hits = reference
+        hits = top_k(doc_vectors, query_vectors, args.k)
+        recall = np.mean([len(a & b) / args.k for a, b in zip(hits, reference_hits)])
+        cosine = np.mean(np.sum(doc_vectors * reference_vectors, axis=1))
+        print(
+            f"{name:<10} {len(chunks) / doc_seconds:>10.1f} {1000 * query_seconds / len(queries):>9.2f} "
+            f"{recall:>9.3f} {cosine:>7.4f}"
+        )
+
+if __name__ == "__main__":
+    main()
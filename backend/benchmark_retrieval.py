@@ -0,0 +1,64 @@
+"""Compare build and query latency of exact NumPy search and FAISS.
+
+Uses random unit vectors (MiniLM's 384 dimensions by default) so only index
+construction and search are measured, not embedding. The FAISS path includes
+the LangChain vectorstore wrapping that build_chain used to pay for.
+
+    python benchmark_retrieval.py --sizes 50 100 200 500 2000
+"""
+import argparse
+import time
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import FakeEmbeddings
+from exact_index import ExactIndex, normalize_rows
+from index_store import search_by_vectors
+
+def random_unit_vectors(count, dim, rng):
+    return normalize_rows(rng.standard_normal((count, dim)))
+
+def build_exact(docs, vectors, embedding):
+    return ExactIndex([str(i) for i in range(len(docs))], docs, vectors, embedding)
+
+def build_faiss(docs, vectors, embedding):
+    text_embeddings = [(doc.page_content, vector) for doc, vector in zip(docs, vectors.tolist())]
+    return FAISS.from_embeddings(text_embeddings, embedding)
+
+def time_ms(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return 1000 * (time.perf_counter() - start) / repeat, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 100, 200, 500, 1000, 5000])
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    embedding = FakeEmbeddings(size=args.dim)
+    queries = random_unit_vectors(args.queries, args.dim, rng)
+
+    print(f"{'chunks':>7} {'exact build':>12} {'faiss build':>12} {'exact query':>12} {'faiss query':>12}  (ms)")
+    for size in args.sizes:
+        vectors = random_unit_vectors(size, args.dim, rng)
+        docs = [Document(page_content=f"chunk {i}") for i in range(size)]
+
+        exact_build, exact = time_ms(lambda: build_exact(docs, vectors, embedding), 5)
+        faiss_build, store = time_ms(lambda: build_faiss(docs, vectors, embedding), 5)
+
+        # Single-query latency, as seen by one /chat retrieval
+        exact_query, _ = time_ms(lambda: [search_by_vectors(exact, q, args.k) for q in queries], 1)
+        faiss_query, _ = time_ms(lambda: [search_by_vectors(store, q, args.k) for q in queries], 1)
+
+        print(
+            f"{size:>7} {exact_build:>12.3f} {faiss_build:>12.3f} "
+            f"{exact_query / len(queries):>12.4f} {faiss_query / len(queries):>12.4f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Assemble retrieved chunks into a compact prompt context.
+
+Chunks are split with a 200 character overlap, so neighbouring hits from the
+same document repeat text. pack_context merges overlapping or adjacent
+chunks of the same source back into one passage (using the splitter's
+start_index), drops near-duplicate passages, and then fills a token budget
+in relevance order.
+"""
+import logging
+import os
+import re
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Word-set Jaccard similarity at or above which a passage counts as a duplicate
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.9"))
+
+_stats = {"contexts": 0, "input_tokens": 0, "packed_tokens": 0, "dropped_duplicates": 0}
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English text)."""
+    return (len(text) + 3) // 4
+
+def _merge_spans(docs):
+    """Merge chunks that overlap or touch within the same source.
+
+    Returns passages as (rank, text), where rank is the best relevance rank
+    of the chunks merged into the passage.
+    """
+    passages = []
+    by_source = {}
+    for rank, doc in enumerate(docs):
+        start = doc.metadata.get("start_index")
+        source = doc.metadata.get("source")
+        if start is None or source is None:
+            passages.append((rank, doc.page_content))
+            continue
+        by_source.setdefault(source, []).append((start, start + len(doc.page_content), rank, doc.page_content))
+
+    for spans in by_source.values():
+        spans.sort()
+        start, end, rank, text = spans[0]
+        for next_start, next_end, next_rank, next_text in spans[1:]:
+            if next_start <= end:
+                if next_end > end:
+                    text += next_text[end - next_start:]
+                    end = next_end
+                rank = min(rank, next_rank)
+            else:
+                passages.append((rank, text))
+                start, end, rank, text = next_start, next_end, next_rank, next_text
+        passages.append((rank, text))
+
+    passages.sort(key=lambda passage: passage[0])
+    return passages
+
+def _words(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+def _is_near_duplicate(words, selected_words):
+    for other in selected_words:
+        union = len(words | other)
+        if union and len(words & other) / union >= NEAR_DUPLICATE_THRESHOLD:
+            return True
+    return False
+
+def pack_context(docs, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Join retrieved documents (most relevant first) into a deduplicated, budgeted context."""
+    selected = []
+    selected_words = []
+    used = 0
+    dropped = 0
+    for _, text in _merge_spans(docs):
+        words = _words(text)
+        if _is_near_duplicate(words, selected_words):
+            dropped += 1
+            continue
+        tokens = estimate_tokens(text)
+        if used + tokens > token_budget:
+            # Always keep some evidence: trim the top passage if it alone overflows
+            if not selected:
+                selected.append(text[:token_budget * 4])
+                used = token_budget
+            break
+        selected.append(text)
+        selected_words.append(words)
+        used += tokens
+
+    _stats["contexts"] += 1
+    _stats["input_tokens"] += sum(estimate_tokens(doc.page_content) for doc in docs)
+    _stats["packed_tokens"] += used
+    _stats["dropped_duplicates"] += dropped
+    return "\n\n".join(selected)
+
+def get_packing_stats():
+    """Return totals of context tokens before and after packing."""
+    return dict(_stats)
@@ -0,0 +1,74 @@
+"""Shared document library that sessions can attach.
+
+Library files live in LIBRARY_DIR and are indexed once, through the same
+shared index storage as sessions but in its own LIBRARY_INDEX_DIR, so no
+client-chosen session id can reach it. The library has its own chunk limit,
+LIBRARY_MAX_CHUNKS, instead of the per-session one.
+Sessions with the library attached query their own index and the library
+index with one query embedding and merge the hits by cosine score, so no
+library content is copied or re-embedded per session.
+"""
+import logging
+import os
+from typing import Any, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+import index_store
+from memory_store import get_session_metadata, update_session_metadata
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+LIBRARY_DIR = os.getenv("LIBRARY_DIR", "library_docs")
+LIBRARY_INDEX_DIR = os.getenv("LIBRARY_INDEX_DIR", "library_index")
+LIBRARY_MAX_CHUNKS = int(os.getenv("LIBRARY_MAX_CHUNKS", "200000"))
+
+os.makedirs(LIBRARY_DIR, exist_ok=True)
+
+def library_has_documents():
+    """Check whether the library holds any documents."""
+    return any(entry.is_file() and not entry.name.startswith('.') for entry in os.scandir(LIBRARY_DIR))
+
+def is_library_attached(session_id):
+    """Check whether a session has the shared library attached."""
+    return bool(get_session_metadata(session_id).get("library_attached"))
+
+def set_library_attached(session_id, attached):
+    """Attach or detach the shared library for a session."""
+    update_session_metadata(session_id, library_attached=bool(attached))
+
+def search_merged(indexes, query_vectors, k=4):
+    """Search several indexes and merge each query's hits by cosine score.
+
+    Chunks with identical text (e.g. a library file also uploaded to the
+    session) are returned once.
+    """
+    per_index = [index_store.search_by_vectors(index, query_vectors, k) for index in indexes]
+    merged = []
+    for hits in zip(*per_index):
+        candidates = sorted((hit for index_hits in hits for hit in index_hits), key=lambda hit: hit[1], reverse=True)
+        seen = set()
+        results = []
+        for doc, score in candidates:
+            if doc.page_content in seen:
+                continue
+            seen.add(doc.page_content)
+            results.append((doc, score))
+            if len(results) == k:
+                break
+        merged.append(results)
+    return merged
+
+class MergedRetriever(BaseRetriever):
+    """LangChain retriever over a session index plus the shared library index."""
+
+    indexes: List[Any]
+    embedding: Any
+    k: int = 4
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        vector = self.embedding.embed_query(query)
+        return [doc for doc, _ in search_merged(self.indexes, [vector], self.k)[0]]
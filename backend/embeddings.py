@@ -0,0 +1,203 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+
+# huggingface (PyTorch via sentence-transformers) or onnx (ONNX Runtime on CPU)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "huggingface")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# 0 lets the runtime pick the thread count
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "256"))
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "true").lower() in ("1", "true", "yes")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models")
+
+_embedding_model = None
+_embedding_lock = threading.Lock()
+
+def normalize_query(text):
+    """Normalize query text for cache lookups (whitespace only; case matters to cased models)."""
+    return " ".join(text.split())
+
+class CachedQueryEmbeddings(Embeddings):
+    """Embeddings wrapper with an LRU cache of query vectors.
+
+    Document embedding passes straight through; only embed_query (used by
+    the retriever) and embed_queries (used for batched retrieval) consult
+    the cache, keyed by model name and normalized query text.
+    """
+
+    def __init__(self, embeddings, model_name, maxsize=QUERY_EMBEDDING_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            vector = self._cache.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def _store(self, key, vector):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._cache[key] = vector
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        key = (self.model_name, normalize_query(text))
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store(key, vector)
+        return list(vector)
+
+    def embed_queries(self, texts):
+        """Embed many queries, computing only cache misses in one batched call."""
+        keys = [(self.model_name, normalize_query(text)) for text in texts]
+        vectors = [self._lookup(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embeddings.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+                self._store(keys[i], vector)
+        return [list(vector) for vector in vectors]
+
+    def stats(self):
+        """Return cache size and hit rate."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._cache),
+                "max_size": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+def export_onnx_model(model_name, quantize=EMBEDDING_QUANTIZE, cache_dir=ONNX_MODEL_DIR):
+    """Export a sentence-transformers model to ONNX once, optionally int8-quantized.
+
+    Returns the directory holding the tokenizer and the path of the model file.
+    """
+    target = os.path.join(cache_dir, model_name.replace("/", "__"))
+    model_path = os.path.join(target, "model.onnx")
+    if not os.path.exists(model_path):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        logger.info(f"Exporting {model_name} to ONNX in {target}")
+        ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(target)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(target)
+
+    if not quantize:
+        return target, model_path
+
+    quantized_path = os.path.join(target, "model_int8.onnx")
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        logger.info(f"Quantizing {model_path} to int8")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return target, quantized_path
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence embeddings computed with ONNX Runtime on CPU.
+
+    Mirrors the all-MiniLM-L6-v2 sentence-transformers pipeline (mean pooling
+    over the attention mask, then L2 normalization), so vectors are
+    interchangeable with HuggingFaceEmbeddings up to quantization error.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, quantize=EMBEDDING_QUANTIZE,
+                 batch_size=EMBEDDING_BATCH_SIZE, threads=EMBEDDING_THREADS,
+                 max_seq_length=EMBEDDING_MAX_SEQ_LENGTH, cache_dir=ONNX_MODEL_DIR):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir, model_path = export_onnx_model(model_name, quantize, cache_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _embed_batch(self, texts):
+        encoded = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np"
+        )
+        feeds = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        token_embeddings = self.session.run(None, feeds)[0]
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts):
+        # Batch texts of similar length together to minimize padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._embed_batch([texts[i] for i in batch])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0].tolist()
+
+def create_embeddings(backend=EMBEDDING_BACKEND, **options):
+    """Create an uncached embedding model for the given backend."""
+    if backend == "onnx":
+        return OnnxEmbeddings(**options)
+    if backend == "huggingface":
+        return HuggingFaceEmbeddings(
+            model_name=options.get("model_name", EMBEDDING_MODEL_NAME),
+            encode_kwargs={"batch_size": options.get("batch_size", EMBEDDING_BATCH_SIZE)}
+        )
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
+
+def get_embedding_id():
+    """Identify the configured model and backend; vectors from different ids are not comparable."""
+    if EMBEDDING_BACKEND == "onnx":
+        return f"{EMBEDDING_MODEL_NAME}:onnx{'-int8' if EMBEDDING_QUANTIZE else ''}"
+    return f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_BACKEND}"
+
+def get_embedding_model():
+    """Return the process-wide embedding model, loading it on first use."""
+    global _embedding_model
+    with _embedding_lock:
+        if _embedding_model is None:
+            logger.info(f"Loading embedding model {get_embedding_id()}")
+            _embedding_model = CachedQueryEmbeddings(create_embeddings(), get_embedding_id())
+        return _embedding_model
+
+def get_query_cache_stats():
+    """Return query embedding cache stats, or None before the model is loaded."""
+    return _embedding_model.stats() if _embedding_model is not None else None
@@ -0,0 +1,66 @@
+"""Exact brute-force vector search for small sessions.
+
+Most sessions hold a few hundred chunks or fewer. For those, one contiguous
+float32 matrix of normalized embeddings answers top-k with a single
+matrix-vector product and np.argpartition, which is faster to build and
+query than a FAISS index wrapped in a LangChain vectorstore.
+"""
+from typing import Any, List
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+def normalize_rows(vectors):
+    """L2-normalize each row of a float32 matrix."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+class ExactIndex:
+    """Cosine-similarity search over normalized embeddings held in one array."""
+
+    def __init__(self, ids, docs, vectors, embedding_function):
+        self.ids = list(ids)
+        self.docs = list(docs)
+        # May be a read-only np.memmap shared between workers
+        self.vectors = vectors
+        self.embedding_function = embedding_function
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search_by_vectors(self, query_vectors, k=4):
+        """Return, for each query vector, the top-k (Document, score) pairs."""
+        queries = normalize_rows(np.atleast_2d(query_vectors))
+        if len(self.ids) == 0:
+            return [[] for _ in range(len(queries))]
+        scores = queries @ self.vectors.T
+        k = min(k, scores.shape[1])
+        if k < scores.shape[1]:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(k), (len(queries), k))
+        results = []
+        for row_scores, row_top in zip(scores, top):
+            ordered = row_top[np.argsort(-row_scores[row_top])]
+            results.append([(self.docs[i], float(row_scores[i])) for i in ordered])
+        return results
+
+    def similarity_search_with_score(self, query, k=4):
+        vector = self.embedding_function.embed_query(query)
+        return self.search_by_vectors(vector, k)[0]
+
+    def as_retriever(self, k=4):
+        return ExactRetriever(index=self, k=k)
+
+class ExactRetriever(BaseRetriever):
+    """LangChain retriever over an ExactIndex."""
+
+    index: Any
+    k: int = 4
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [doc for doc, _ in self.index.similarity_search_with_score(query, self.k)]
@@ -0,0 +1,192 @@
+"""Per-session manifest of uploaded files and scraped pages.
+
+The manifest (session_memory/<session_id>_files.json) is the single source
+for /uploaded_files. Upload, scrape, delete and OCR steps update it under an
+exclusive file lock and replace it atomically, so listing a session's files
+is one read instead of a directory scan plus per-file stat calls.
+
+Older deployments stored only scrape metadata in the same file as a flat
+{filename: {...}} mapping; it is migrated on first access by rescanning the
+session's upload directory once.
+"""
+import fcntl
+import json
+import logging
+import os
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from memory_store import MEMORY_DIR
+import storage_codec
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploaded_docs"
+MANIFEST_VERSION = 1
+
+def human_readable_size(size_bytes):
+    """Convert bytes to human-readable format"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024:
+            return f"{size_bytes:.1f} {unit}"
+        size_bytes /= 1024
+    return f"{size_bytes:.1f} TB"
+
+def is_image_file(filename):
+    """Check if file is an image"""
+    image_exts = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+    return os.path.splitext(filename)[1].lower() in image_exts
+
+def needs_ocr(filename):
+    """Check if a file is an image or PDF that may need OCR."""
+    return is_image_file(filename) or filename.lower().endswith('.pdf')
+
+def is_ocr_sidecar(filename):
+    """Check if a name is reserved for OCR text sidecars (<file>.ocr.txt, in any codec)."""
+    return storage_codec.strip_codec_suffix(filename).endswith('.ocr.txt')
+
+def compressed_text_names(manifest):
+    """Names of the session's files written compressed by this app (scraped pages)."""
+    return {name for name, entry in manifest["files"].items() if entry.get("type") == "webpage"}
+
+def get_manifest_path(session_id):
+    """Get the file path for storing a session's file manifest."""
+    return os.path.join(MEMORY_DIR, f"{session_id}_files.json")
+
+def get_manifest_lock_path(session_id):
+    """Get the lock file guarding manifest updates."""
+    return os.path.join(MEMORY_DIR, f"{session_id}_files.lock")
+
+def _build_entry(doc_dir, name, file_info):
+    """Create the listing entry for one file from its stat and metadata."""
+    file_stat = os.stat(os.path.join(doc_dir, name))
+    return {
+        "name": name,
+        "display_name": file_info.get("original_url") or name,
+        "original_url": file_info.get("original_url"),
+        "type": file_info.get("type", "file"),
+        "scraped_at": file_info.get("scraped_at"),
+        "size": file_stat.st_size,
+        "human_size": human_readable_size(file_stat.st_size),
+        "modified": file_stat.st_mtime,
+        "modified_iso": datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
+        "extension": os.path.splitext(name)[1].lower(),
+        "is_image": is_image_file(name),
+        "ocr_processed": needs_ocr(name) and storage_codec.exists(os.path.join(doc_dir, f"{name}.ocr.txt"))
+    }
+
+def _scan(session_id, legacy_metadata):
+    """Rebuild manifest entries from the upload directory."""
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    files = {}
+    if not os.path.exists(doc_dir):
+        return files
+    for entry in os.scandir(doc_dir):
+        # Skip OCR-generated files (*.ocr.txt)
+        if not entry.is_file() or is_ocr_sidecar(entry.name):
+            continue
+        try:
+            files[entry.name] = _build_entry(doc_dir, entry.name, legacy_metadata.get(entry.name, {}))
+        except Exception as e:
+            logger.warning(f"Error processing {entry.name}: {e}")
+            files[entry.name] = {"name": entry.name, "display_name": entry.name, "error": str(e)}
+    return files
+
+def _new_manifest(session_id, legacy_metadata=None):
+    return {
+        "version": MANIFEST_VERSION,
+        "id": uuid.uuid4().hex[:12],
+        "revision": 1,
+        "files": _scan(session_id, legacy_metadata or {})
+    }
+
+def _load(session_id):
+    """Load the manifest, migrating legacy metadata or rebuilding it if needed."""
+    manifest_path = get_manifest_path(session_id)
+    data = None
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading file manifest for session {session_id}: {e}")
+
+    if isinstance(data, dict) and data.get("version") == MANIFEST_VERSION:
+        return data, False
+
+    logger.info(f"Building file manifest for session {session_id}")
+    return _new_manifest(session_id, data if isinstance(data, dict) else {}), True
+
+def _write(session_id, manifest):
+    manifest_path = get_manifest_path(session_id)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+@contextmanager
+def _locked(session_id):
+    with open(get_manifest_lock_path(session_id), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _update(session_id, mutate):
+    """Apply mutate(files) to the manifest as one locked read-modify-write."""
+    with _locked(session_id):
+        manifest, _ = _load(session_id)
+        mutate(manifest["files"])
+        manifest["revision"] += 1
+        _write(session_id, manifest)
+        return manifest
+
+def record_file(session_id, filename, **file_info):
+    """Add or refresh a file's entry after it has been written to disk."""
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    def mutate(files):
+        files[filename] = _build_entry(doc_dir, filename, file_info)
+    return _update(session_id, mutate)
+
+def remove_file(session_id, filename):
+    """Drop a file's entry after it has been deleted."""
+    return _update(session_id, lambda files: files.pop(filename, None))
+
+def set_ocr_processed(session_id, filename, processed=True):
+    """Mark whether a file's OCR sidecar is available."""
+    def mutate(files):
+        if filename in files:
+            files[filename]["ocr_processed"] = processed
+    return _update(session_id, mutate)
+
+def set_chunk_usage(session_id, total, indexed):
+    """Record how many chunks the session's documents produced and how many were indexed."""
+    usage = {"total": total, "indexed": indexed, "truncated": indexed < total}
+    with _locked(session_id):
+        manifest, _ = _load(session_id)
+        if manifest.get("chunks") == usage:
+            return manifest
+        manifest["chunks"] = usage
+        manifest["revision"] += 1
+        _write(session_id, manifest)
+        return manifest
+
+def read_manifest(session_id):
+    """Return the session's manifest, creating it from the upload directory if missing."""
+    manifest, created = _load(session_id)
+    if created:
+        with _locked(session_id):
+            manifest, created = _load(session_id)
+            if created:
+                _write(session_id, manifest)
+    return manifest
+
+def manifest_etag(manifest):
+    """ETag identifying one revision of a manifest."""
+    return f'"{manifest["id"]}-{manifest["revision"]}"'
+
+def list_files(manifest):
+    """Return manifest entries newest first, as served by /uploaded_files."""
+    return sorted(manifest["files"].values(), key=lambda x: x.get("modified", 0), reverse=True)
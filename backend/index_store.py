@@ -0,0 +1,349 @@
+"""Shared on-disk storage for per-session vector indexes.
+
+Each session's index lives in versioned generation directories:
+
+    session_index/<session_id>/
+        .lock           exclusive flock held while a new generation is written
+        CURRENT         name of the newest complete generation
+        gen-000002/     chunks.json, embeddings.npy, [index.faiss], fingerprint, embedding
+
+chunks.json holds the chunk ids and documents and embeddings.npy their
+normalized float32 vectors in the same row order. Neither format can carry
+code, so generations imported from snapshots are validated and re-published
+with a freshly built index.faiss rather than trusted as-is. Sessions above
+EXACT_SEARCH_MAX_CHUNKS also get a FAISS index.faiss; smaller ones are served
+by exact NumPy search straight from embeddings.npy.
+
+Writers build into a temporary directory, rename it into place and then
+atomically replace CURRENT, so readers never observe a half-written index.
+Readers memory-map index.faiss / embeddings.npy read-only, letting every
+uvicorn worker (or node, when INDEX_DIR is on a shared volume) serve the same
+session from one copy in the page cache instead of rebuilding and holding its
+own.
+"""
+import fcntl
+import hashlib
+import logging
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from exact_index import ExactIndex, normalize_rows
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.getenv("INDEX_DIR", "session_index")
+# Generations kept on disk; older ones may still be mapped by slower workers
+INDEX_KEEP_GENERATIONS = int(os.getenv("INDEX_KEEP_GENERATIONS", "2"))
+# Sessions with at most this many chunks use exact NumPy search instead of FAISS
+EXACT_SEARCH_MAX_CHUNKS = int(os.getenv("EXACT_SEARCH_MAX_CHUNKS", "200"))
+
+os.makedirs(INDEX_DIR, exist_ok=True)
+
+_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+# index dir -> (generation, fingerprint, vectorstore) loaded by this process
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+def get_session_index_dir(session_id):
+    """Get the directory holding all index generations for a session."""
+    return os.path.join(INDEX_DIR, session_id)
+
+@contextmanager
+def _locked(index_dir, shared=False):
+    """Hold the session's index lock: exclusive for writers, shared for readers."""
+    with open(os.path.join(index_dir, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def docs_fingerprint(doc_dir):
+    """Fingerprint a document directory from file names, sizes and mtimes."""
+    digest = hashlib.sha1()
+    entries = sorted(
+        (entry.name, entry.stat())
+        for entry in os.scandir(doc_dir) if entry.is_file() and not entry.name.startswith('.')
+    )
+    for name, stat in entries:
+        digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def index_fingerprint(doc_dir, embedding_id):
+    """Fingerprint identifying an index of doc_dir built with a given embedding model."""
+    return hashlib.sha1(f"{docs_fingerprint(doc_dir)}\0{embedding_id}".encode("utf-8")).hexdigest()
+
+def _read_current(index_dir):
+    """Return (generation, fingerprint) of the newest complete generation, if any."""
+    try:
+        with open(os.path.join(index_dir, "CURRENT"), "r") as f:
+            generation = f.read().strip()
+        # Generations written before the chunk store format are rebuilt
+        if not os.path.exists(os.path.join(index_dir, generation, "chunks.json")):
+            return None, None
+        with open(os.path.join(index_dir, generation, "fingerprint"), "r") as f:
+            return generation, f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return None, None
+
+def _read_embedding_id(index_dir, generation):
+    """Return the embedding model id a generation was built with, if recorded."""
+    try:
+        with open(os.path.join(index_dir, generation, "embedding"), "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def _read_chunks(path):
+    """Read (ids, docs) from a generation's chunks.json."""
+    with open(os.path.join(path, "chunks.json"), "r", encoding="utf-8") as f:
+        chunks = json.load(f)
+    ids = chunks["ids"]
+    docs = [Document(page_content=doc["page_content"], metadata=doc["metadata"]) for doc in chunks["docs"]]
+    return ids, docs
+
+def _load_chunk_store(index_dir, generation):
+    """Read a generation's (ids, docs, vectors) fully into memory for updating."""
+    path = os.path.join(index_dir, generation)
+    ids, docs = _read_chunks(path)
+    return ids, docs, np.load(os.path.join(path, "embeddings.npy"), allow_pickle=False)
+
+def _load_generation(index_dir, generation, embedding):
+    """Load a generation for serving, memory-mapping its vectors read-only."""
+    path = os.path.join(index_dir, generation)
+    ids, docs = _read_chunks(path)
+
+    faiss_path = os.path.join(path, "index.faiss")
+    if not os.path.exists(faiss_path):
+        vectors = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r", allow_pickle=False)
+        return ExactIndex(ids, docs, vectors, embedding)
+
+    try:
+        index = faiss.read_index(faiss_path, _MMAP_FLAGS)
+    except RuntimeError as e:
+        # Index types without mmap support are read into memory instead
+        logger.warning(f"Memory-mapped load failed for {path}, reading into memory: {e}")
+        index = faiss.read_index(faiss_path)
+    return FAISS(
+        embedding_function=embedding,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, docs))),
+        index_to_docstore_id=dict(enumerate(ids))
+    )
+
+def _publish_generation(index_dir, fill):
+    """Create the next generation by calling fill(tmp_path), then publish it via CURRENT."""
+    generations = sorted(d for d in os.listdir(index_dir) if d.startswith("gen-"))
+    next_number = int(generations[-1][4:]) + 1 if generations else 1
+    generation = f"gen-{next_number:06d}"
+
+    tmp_path = os.path.join(index_dir, f".tmp-{generation}")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    fill(tmp_path)
+    os.rename(tmp_path, os.path.join(index_dir, generation))
+
+    current_tmp = os.path.join(index_dir, "CURRENT.tmp")
+    with open(current_tmp, "w") as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(current_tmp, os.path.join(index_dir, "CURRENT"))
+
+    # Unlinked files stay readable for workers that still have them mapped
+    for old in (generations + [generation])[:-INDEX_KEEP_GENERATIONS]:
+        shutil.rmtree(os.path.join(index_dir, old), ignore_errors=True)
+
+    return generation
+
+def _write_generation(index_dir, chunk_store, fingerprint, embedding_id):
+    """Persist a chunk store as the next generation and publish it."""
+    ids, docs, vectors = chunk_store
+
+    def fill(tmp_path):
+        chunks = {
+            "ids": list(ids),
+            "docs": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+        }
+        with open(os.path.join(tmp_path, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(chunks, f, default=str)
+        np.save(os.path.join(tmp_path, "embeddings.npy"), vectors)
+        if len(ids) > EXACT_SEARCH_MAX_CHUNKS:
+            index = faiss.IndexFlatL2(vectors.shape[1])
+            index.add(vectors)
+            faiss.write_index(index, os.path.join(tmp_path, "index.faiss"))
+        with open(os.path.join(tmp_path, "fingerprint"), "w") as f:
+            f.write(fingerprint)
+        with open(os.path.join(tmp_path, "embedding"), "w") as f:
+            f.write(embedding_id)
+
+    return _publish_generation(index_dir, fill)
+
+def get_vectorstore(session_id, doc_dir, build_fn, embedding, index_dir=None):
+    """Return the session's vectorstore, building it only if no worker has yet.
+
+    build_fn(previous) must return the (ids, docs, vectors) chunk store for
+    doc_dir, with vectors an L2-normalized float32 matrix. previous is the
+    last published chunk store (or None), so build_fn can update it
+    incrementally. It is called at most once per change to the documents
+    across all workers that share INDEX_DIR.
+
+    index_dir overrides where the generations are kept (by default
+    INDEX_DIR/<session_id>), for indexes that are not a session's, such as the
+    shared library; session_id is then only used in log messages.
+
+    Returns an ExactIndex for small sessions or a FAISS vectorstore otherwise.
+    """
+    # Switching embedding model or backend must invalidate stored vectors
+    embedding_id = getattr(embedding, "model_name", type(embedding).__name__)
+    fingerprint = index_fingerprint(doc_dir, embedding_id)
+
+    index_dir = index_dir or get_session_index_dir(session_id)
+    with _loaded_lock:
+        cached = _loaded.get(index_dir)
+    if cached and cached[1] == fingerprint:
+        return cached[2]
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    generation, stored_fingerprint = _read_current(index_dir)
+    if generation is None or stored_fingerprint != fingerprint:
+        with _locked(index_dir):
+            # Another worker may have published this generation while we waited
+            generation, stored_fingerprint = _read_current(index_dir)
+            if generation is None or stored_fingerprint != fingerprint:
+                logger.info(f"Building index for session {session_id}")
+                previous = None
+                if generation is not None and _read_embedding_id(index_dir, generation) == embedding_id:
+                    try:
+                        previous = _load_chunk_store(index_dir, generation)
+                    except Exception as e:
+                        logger.warning(f"Cannot reuse index {generation} for session {session_id}: {e}")
+                generation = _write_generation(index_dir, build_fn(previous), fingerprint, embedding_id)
+
+    vectorstore = _load_generation(index_dir, generation, embedding)
+    with _loaded_lock:
+        _loaded[index_dir] = (generation, fingerprint, vectorstore)
+    mode = "exact" if isinstance(vectorstore, ExactIndex) else "faiss"
+    logger.info(f"Loaded index {generation} for session {session_id} ({mode} search)")
+    return vectorstore
+
+def search_by_vectors(vectorstore, query_vectors, k=4):
+    """Top-k (Document, cosine score) pairs per query for either index type."""
+    queries = normalize_rows(np.atleast_2d(query_vectors))
+    if isinstance(vectorstore, ExactIndex):
+        return vectorstore.search_by_vectors(queries, k)
+
+    distances, indices = vectorstore.index.search(queries, k)
+    results = []
+    for row_distances, row_indices in zip(distances, indices):
+        # Squared L2 between unit vectors is 2 - 2cos; FAISS pads with -1 when short
+        results.append([
+            (vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]), float(1 - distance / 2))
+            for distance, i in zip(row_distances, row_indices) if i != -1
+        ])
+    return results
+
+@contextmanager
+def current_generation(session_id):
+    """Yield (generation_dir, fingerprint, embedding_id) of the published index, or Nones.
+
+    A shared lock keeps writers from replacing the generation while the
+    caller reads its files.
+    """
+    index_dir = get_session_index_dir(session_id)
+    if not os.path.isdir(index_dir):
+        yield None, None, None
+        return
+    with _locked(index_dir, shared=True):
+        generation, fingerprint = _read_current(index_dir)
+        if generation is None:
+            yield None, None, None
+        else:
+            yield os.path.join(index_dir, generation), fingerprint, _read_embedding_id(index_dir, generation)
+
+def _read_untrusted_chunk_store(source_dir):
+    """Read and validate (ids, docs, vectors) from generation files of unknown origin.
+
+    Only chunks.json and embeddings.npy are read; any index.faiss is ignored.
+    Raises ValueError if the files are malformed or inconsistent.
+    """
+    try:
+        with open(os.path.join(source_dir, "chunks.json"), "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+        ids, raw_docs = chunks["ids"], chunks["docs"]
+        vectors = np.load(os.path.join(source_dir, "embeddings.npy"), allow_pickle=False)
+    except (OSError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Unreadable index files: {e}")
+
+    if not isinstance(ids, list) or not isinstance(raw_docs, list) or len(ids) != len(raw_docs):
+        raise ValueError("chunks.json must list one document per chunk id")
+    if not all(isinstance(chunk_id, str) for chunk_id in ids) or len(set(ids)) != len(ids):
+        raise ValueError("Chunk ids must be unique strings")
+    docs = []
+    for doc in raw_docs:
+        if (not isinstance(doc, dict) or not isinstance(doc.get("page_content"), str)
+                or not isinstance(doc.get("metadata"), dict)):
+            raise ValueError("Malformed chunk document")
+        docs.append(Document(page_content=doc["page_content"], metadata=doc["metadata"]))
+    if vectors.dtype != np.float32 or vectors.ndim != 2 or vectors.shape[0] != len(ids) or not vectors.shape[1]:
+        raise ValueError(f"Embeddings must be a float32 matrix with {len(ids)} rows")
+    if not np.isfinite(vectors).all():
+        raise ValueError("Embeddings contain non-finite values")
+    return ids, docs, normalize_rows(vectors)
+
+def import_generation(session_id, source_dir, fingerprint, embedding_id):
+    """Publish a chunk store from elsewhere (e.g. a snapshot) as the session's index.
+
+    The chunk store is validated and written as a new generation, building
+    any FAISS index locally. fingerprint replaces the stored one, since it
+    depends on file mtimes that do not survive the copy. Raises ValueError if
+    the files are not a valid chunk store.
+    """
+    chunk_store = _read_untrusted_chunk_store(source_dir)
+    index_dir = get_session_index_dir(session_id)
+    os.makedirs(index_dir, exist_ok=True)
+
+    with _locked(index_dir):
+        generation = _write_generation(index_dir, chunk_store, fingerprint, embedding_id)
+    evict(session_id)
+    return generation
+
+def is_loaded(session_id):
+    """Check whether this process already has the session's index mapped."""
+    with _loaded_lock:
+        return get_session_index_dir(session_id) in _loaded
+
+def stored_size(session_id):
+    """Approximate bytes of the session's published index generation (0 if none).
+
+    Reads CURRENT without taking the index lock, so it never waits behind a
+    rebuild; a generation replaced mid-scan just reports 0.
+    """
+    index_dir = get_session_index_dir(session_id)
+    generation, _ = _read_current(index_dir)
+    if generation is None:
+        return 0
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(os.path.join(index_dir, generation)) if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+def evict(session_id):
+    """Drop this process's mapping of a session's index."""
+    with _loaded_lock:
+        return _loaded.pop(get_session_index_dir(session_id), None) is not None
+
+def delete_index(session_id):
+    """Remove all stored index generations for a session."""
+    evict(session_id)
+    shutil.rmtree(get_session_index_dir(session_id), ignore_errors=True)
@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+groq_api_key = os.getenv("GROQ_API_KEY")
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gemma2-9b-it")
+# groq (hosted), openai_compat (any OpenAI-compatible server, e.g. llm_stub_server.py) or fake (in-process)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "groq")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://localhost:8001/v1")
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "10"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "45"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+# Retries use the client SDK's exponential backoff with jitter
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))
+
+_clients = {}
+_http_clients = []
+_clients_lock = threading.Lock()
+
+def get_llm(model=LLM_MODEL):
+    """Return the shared chat model client for a model, creating it on first use."""
+    with _clients_lock:
+        if model not in _clients:
+            _clients[model] = _create_llm(model)
+            logger.info(f"Created {LLM_BACKEND} LLM client for {model} (pool size {LLM_POOL_SIZE})")
+        return _clients[model]
+
+def _create_http_client():
+    """Create a keep-alive connection pool shared by every request to one model."""
+    client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=LLM_POOL_SIZE,
+            max_keepalive_connections=LLM_POOL_SIZE
+        ),
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    )
+    _http_clients.append(client)
+    return client
+
+def _create_llm(model):
+    if LLM_BACKEND == "groq":
+        from langchain_groq import ChatGroq
+        return ChatGroq(
+            model=model,
+            api_key=groq_api_key,
+            http_client=_create_http_client(),
+            timeout=LLM_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES
+        )
+
+    if LLM_BACKEND == "openai_compat":
+        from langchain_openai import ChatOpenAI
+        return ChatOpenAI(
+            model=model,
+            base_url=LLM_BASE_URL,
+            api_key=os.getenv("LLM_API_KEY", "not-needed"),
+            http_client=_create_http_client(),
+            timeout=LLM_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES
+        )
+
+    if LLM_BACKEND == "fake":
+        from langchain_core.language_models.fake_chat_models import FakeListChatModel
+        return FakeListChatModel(
+            responses=["This is a canned response from the local fake LLM backend."],
+            sleep=FAKE_LLM_LATENCY or None
+        )
+
+    raise ValueError(f"Unknown LLM_BACKEND: {LLM_BACKEND}")
+
+def close_llm_clients():
+    """Close pooled HTTP connections; called on application shutdown."""
+    with _clients_lock:
+        for client in _http_clients:
+            client.close()
+        _http_clients.clear()
+        _clients.clear()
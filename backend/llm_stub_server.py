@@ -0,0 +1,48 @@
+"""Minimal OpenAI-compatible chat completions server for offline load tests.
+
+Run with `python llm_stub_server.py` and start the API with
+LLM_BACKEND=openai_compat LLM_BASE_URL=http://localhost:8001/v1.
+"""
+import asyncio
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from fastapi import FastAPI
+from pydantic import BaseModel
+
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "0.2"))
+STUB_RESPONSE = os.getenv("STUB_RESPONSE", "This is a canned response from the stub LLM server.")
+
+app = FastAPI()
+
+class ChatCompletionRequest(BaseModel):
+    model: str
+    messages: List[Dict[str, Any]]
+    stream: Optional[bool] = False
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: ChatCompletionRequest):
+    """Return a fixed completion after a configurable delay."""
+    await asyncio.sleep(STUB_LATENCY)
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in request.messages)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": STUB_RESPONSE},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": len(STUB_RESPONSE) // 4,
+            "total_tokens": (prompt_chars + len(STUB_RESPONSE)) // 4
+        }
+    }
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("STUB_PORT", "8001")))
@@ -1,23 +1,50 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse, FileResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers, MutableHeaders
 from pydantic import BaseModel, ValidationError
-from rag_chain import build_chain
+from rag_chain import (
+    build_chain, create_conversation_chain, prepare_batch, answer_batch, has_retrievable_documents, get_indexing_stats, BATCH_MAX_CONCURRENCY
+)
+from document_library import LIBRARY_DIR, set_library_attached, is_library_attached
+from singleflight import SingleFlight
+from llm_client import close_llm_clients
+from file_manifest import (
+    record_file, remove_file, read_manifest, manifest_etag, list_files,
+    human_readable_size, is_ocr_sidecar
+)
+from ocr_stage import schedule_ocr, discard_sidecar, shutdown_ocr, get_ocr_stats
+from embeddings import get_query_cache_stats
+from context_packer import get_packing_stats
+from storage_codec import write_text, get_storage_stats
+from query_router import route_query, needs_retrieval, log_decision, record_latency, get_router_stats
+from request_profiler import (
+    PROFILED_PATHS, PROFILE_ADMIN_TOKEN, should_profile, valid_request_id, start_profile, finish_profile,
+    read_profile, list_profiles, get_profiler_stats
+)
+from session_prefetch import schedule_prefetch, claim_prefetch, cancel_prefetches, get_prefetch_stats
+from session_snapshot import SNAPSHOT_DIR, export_session, import_session
+from session_janitor import (
+    touch_session, check_quota, purge_session, run_janitor, get_janitor_stats
+)
 from memory_store import (
-    get_memory, save_memory, format_chat_history, clear_memory, 
-    save_session_metadata, get_session_metadata, get_all_sessions_metadata
+    get_memory, format_chat_history,
+    save_session_metadata, get_session_metadata, get_all_sessions_metadata,
+    patch_memory, assign_message_ids, page_history, history_since
 )
 from langchain_core.messages import HumanMessage, AIMessage
 from typing import Dict, Any, List, Optional
 import uuid
 import os
-import shutil
 import re
+import tarfile
 import logging
+import time
 import traceback
 from pathlib import Path
 import asyncio
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, closing
 from datetime import datetime
 from bs4 import BeautifulSoup
 import requests
@@ -35,13 +62,22 @@ MEMORY_DIR = "session_memory"
 Path(UPLOAD_DIR).mkdir(exist_ok=True)
 Path(MEMORY_DIR).mkdir(exist_ok=True)
 
+# Coalesce concurrent duplicate work (double-clicks, frontend retries)
+chain_builds = SingleFlight("chain_build")
+llm_calls = SingleFlight("llm_invoke")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting FastAPI application")
+    janitor_task = asyncio.create_task(run_janitor())
     yield
     # Shutdown
     logger.info("Shutting down FastAPI application")
+    janitor_task.cancel()
+    cancel_prefetches()
+    shutdown_ocr()
+    close_llm_clients()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -74,6 +110,47 @@ class WebLinksInput(BaseModel):
     session_id: str
     urls: List[str]
 
+class PatchChatHistoryRequest(BaseModel):
+    session_id: str
+    operations: List[Dict[str, Any]]
+
+class AttachLibraryRequest(BaseModel):
+    session_id: str
+    attached: bool = True
+
+class ChatBatchInput(BaseModel):
+    session_id: str
+    questions: List[str]
+    include_history: bool = False
+    max_concurrency: int = BATCH_MAX_CONCURRENCY
+
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", "500"))
+MAX_SNAPSHOT_BYTES = int(os.getenv("MAX_SNAPSHOT_BYTES", str(500 * 1024 * 1024)))
+
+# Library changes require a matching X-Admin-Token header; without it they are disabled
+LIBRARY_ADMIN_TOKEN = os.getenv("LIBRARY_ADMIN_TOKEN")
+
+def require_library_admin(request: Request):
+    """Reject library changes unless the admin token is configured and supplied."""
+    if not LIBRARY_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Library changes are disabled (LIBRARY_ADMIN_TOKEN not set)")
+    if request.headers.get("x-admin-token") != LIBRARY_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def require_profile_admin(request: Request):
+    """Reject profile access unless the admin token is configured and supplied."""
+    if not PROFILE_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Profile access is disabled (PROFILE_ADMIN_TOKEN not set)")
+    if request.headers.get("x-admin-token") != PROFILE_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def prefetch_session(session_id):
+    """Warm the session's index and chain in the background, ahead of its first message."""
+    schedule_prefetch(
+        session_id,
+        lambda: chain_builds.run(("build", session_id), build_chain, session_id)
+    )
+
 def generate_chat_title(first_message: str) -> str:
     """Generate a meaningful chat title from the first user message."""
     try:
@@ -102,6 +179,49 @@ async def global_exception_handler(request: Request, exc: Exception):
         }
     )
 
+class ProfileRequestsMiddleware:
+    """Profile opted-in or sampled chat and ingestion requests.
+
+    A plain ASGI middleware, so requests to other paths (including streamed
+    responses) pass straight through without being wrapped.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in PROFILED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        
+        headers = Headers(scope=scope)
+        request_id = headers.get("x-request-id")
+        if not valid_request_id(request_id):
+            request_id = uuid.uuid4().hex
+        
+        profile = start_profile(request_id, scope["method"], scope["path"]) if should_profile(headers) else None
+        status_code = 500
+        
+        async def send_with_ids(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                response_headers = MutableHeaders(scope=message)
+                response_headers["X-Request-ID"] = request_id
+                if profile is not None:
+                    response_headers["X-Profile-ID"] = request_id
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_ids)
+        finally:
+            if profile is not None:
+                try:
+                    await asyncio.to_thread(finish_profile, profile, status_code)
+                except Exception as e:
+                    logger.error(f"Error storing profile {request_id}: {e}")
+
+app.add_middleware(ProfileRequestsMiddleware)
+
 @app.post("/chat")
 async def chat(request: ChatInput):
     """Handle chat messages with improved error handling."""
@@ -109,9 +229,8 @@ async def chat(request: ChatInput):
         session_id = request.session_id
         user_input = request.message
 
-        # Document check
-        doc_dir = os.path.join(UPLOAD_DIR, session_id)
-        if not os.path.exists(doc_dir) or not any(os.scandir(doc_dir)):
+        # Document check (the session's own files or the attached library)
+        if not has_retrievable_documents(session_id):
             return JSONResponse(
                 status_code=200,
                 content={
@@ -142,6 +261,9 @@ async def chat(request: ChatInput):
                 }
             )
 
+        touch_session(session_id)
+        claim_prefetch(session_id)
+
         # Get chat history with error handling
         try:
             chat_history = get_memory(session_id)
@@ -164,9 +286,17 @@ async def chat(request: ChatInput):
             logger.error(f"Error formatting chat history: {e}")
             formatted_history = ""
             
-        # Get the RAG chain with timeout
+        # Small talk and questions about the conversation itself skip retrieval
+        route, route_reason = route_query(user_input, chat_history)
+        log_decision(session_id, user_input, route, route_reason)
+        started = time.perf_counter()
+            
+        # Get the RAG chain, sharing any build already in flight for this session
         try:
-            rag_chain = build_chain(session_id)
+            if needs_retrieval(route):
+                rag_chain, _ = await chain_builds.run(("build", session_id), build_chain, session_id)
+            else:
+                rag_chain = create_conversation_chain()
         except Exception as e:
             logger.error(f"Error building RAG chain: {e}")
             return JSONResponse(
@@ -180,9 +310,10 @@ async def chat(request: ChatInput):
             
         # Process the user input with timeout and error handling
         try:
-            # Add timeout to prevent hanging
-            response = await asyncio.wait_for(
-                asyncio.to_thread(
+            # Add timeout to prevent hanging; identical concurrent questions share one call
+            response, shared = await asyncio.wait_for(
+                llm_calls.run(
+                    ("chat", session_id, user_input, formatted_history),
                     rag_chain.invoke,
                     {
                         "question": user_input,
@@ -193,6 +324,7 @@ async def chat(request: ChatInput):
             )
             
             logger.info(f"Generated response for session {session_id}")
+            record_latency(session_id, route, time.perf_counter() - started)
             
         except asyncio.TimeoutError:
             logger.error(f"RAG chain timeout for session {session_id}")
@@ -216,28 +348,39 @@ async def chat(request: ChatInput):
                 }
             )
             
-        # Update chat history with error handling
+        # A coalesced duplicate request must not record the exchange twice
+        if shared:
+            logger.info(f"Returning shared response for duplicate request in session {session_id}")
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "response": response,
+                    "session_id": session_id
+                }
+            )
+
+        # Update chat history with error handling; patching (rather than saving the
+        # history read before the LLM call) keeps edits made in the meantime
         try:
-            # Add human message
-            chat_history.append({
-                'content': user_input,
-                'type': 'HumanMessage',
-                'id': str(uuid.uuid4()),
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            # Add AI's response with alternatives structure
-            chat_history.append({
-                'content': response,
-                'type': 'AIMessage',
-                'id': str(uuid.uuid4()),
-                'alternatives': [response],  # Initialize with first response
-                'active_index': 0,
-                'regeneration_count': 0,
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            save_memory(session_id, chat_history)
+            patch_memory(session_id, [
+                # Add human message
+                {"op": "append", "message": {
+                    'content': user_input,
+                    'type': 'HumanMessage',
+                    'id': str(uuid.uuid4()),
+                    'timestamp': datetime.now().isoformat()
+                }},
+                # Add AI's response with alternatives structure
+                {"op": "append", "message": {
+                    'content': response,
+                    'type': 'AIMessage',
+                    'id': str(uuid.uuid4()),
+                    'alternatives': [response],  # Initialize with first response
+                    'active_index': 0,
+                    'regeneration_count': 0,
+                    'timestamp': datetime.now().isoformat()
+                }}
+            ])
         except Exception as e:
             logger.error(f"Error saving chat history: {e}")
             
@@ -289,9 +432,8 @@ async def regenerate_response(request: ChatInput):
                 }
             )
 
-        # Check if files uploaded for this session
-        doc_dir = os.path.join(UPLOAD_DIR, session_id)
-        if not os.path.exists(doc_dir) or not any(os.scandir(doc_dir)):
+        # Check if files uploaded for this session or the library is attached
+        if not has_retrievable_documents(session_id):
             return JSONResponse(
                 status_code=200,
                 content={
@@ -301,6 +443,9 @@ async def regenerate_response(request: ChatInput):
                 }
             )
 
+        touch_session(session_id)
+        claim_prefetch(session_id)
+
         # Get chat history
         chat_history = get_memory(session_id)
         
@@ -342,40 +487,58 @@ Previous responses given: {len(last_ai_message.get('alternatives', []))}
 User's original question: {user_input}
 """
         
-        # Get the RAG chain
-        rag_chain = build_chain(session_id)
+        # Get the RAG chain, or the plain LLM chain for turns that need no retrieval
+        route, route_reason = route_query(user_input, chat_history)
+        log_decision(session_id, user_input, route, route_reason)
+        started = time.perf_counter()
+        if needs_retrieval(route):
+            rag_chain, _ = await chain_builds.run(("build", session_id), build_chain, session_id)
+        else:
+            rag_chain = create_conversation_chain()
         
         # Generate new response with regeneration context
-        response = await asyncio.wait_for(
-            asyncio.to_thread(
+        regeneration_question = f"{regeneration_prompt}\n\nOriginal Question: {user_input}"
+        response, shared = await asyncio.wait_for(
+            llm_calls.run(
+                ("regenerate", session_id, regeneration_question, formatted_history),
                 rag_chain.invoke,
                 {
-                    "question": f"{regeneration_prompt}\n\nOriginal Question: {user_input}",
+                    "question": regeneration_question,
                     "chat_history": formatted_history
                 }
             ),
             timeout=60.0
         )
+        record_latency(session_id, route, time.perf_counter() - started)
         
-        # Update the AI message with new alternative
-        if not last_ai_message.get('alternatives'):
-            last_ai_message['alternatives'] = [last_ai_message['content']]
-        
-        last_ai_message['alternatives'].append(response)
-        last_ai_message['active_index'] = len(last_ai_message['alternatives']) - 1
-        last_ai_message['content'] = response  # Update current content
-        last_ai_message['regeneration_count'] = last_ai_message.get('regeneration_count', 0) + 1
+        # The request that started the call records the alternative
+        if shared:
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "response": response,
+                    "session_id": session_id,
+                    "alternatives_count": len(last_ai_message.get('alternatives', [])) + 1,
+                    "regeneration_count": last_ai_message.get('regeneration_count', 0) + 1
+                }
+            )
         
-        # Save updated chat history
-        save_memory(session_id, chat_history)
+        # Add the new alternative as a patch, keeping edits made during the LLM call
+        chat_history = patch_memory(session_id, [{
+            "op": "add_alternative",
+            "message_id": last_ai_message['id'],
+            "content": response,
+            "regeneration": True
+        }])
+        updated_message = next(m for m in chat_history if m.get('id') == last_ai_message['id'])
         
         return JSONResponse(
             status_code=200,
             content={
                 "response": response,
                 "session_id": session_id,
-                "alternatives_count": len(last_ai_message['alternatives']),
-                "regeneration_count": last_ai_message['regeneration_count']
+                "alternatives_count": len(updated_message['alternatives']),
+                "regeneration_count": updated_message['regeneration_count']
             }
         )
         
@@ -390,16 +553,59 @@ User's original question: {user_input}
             }
         )
     
+@app.post("/chat_batch")
+async def chat_batch(request: ChatBatchInput):
+    """Answer many questions against one session, streamed back as NDJSON.
+
+    Results arrive in completion order, one JSON object per line with the
+    question's index. Answers are not added to the session's chat history.
+    """
+    session_id = request.session_id
+    if not session_id or not session_id.strip():
+        raise HTTPException(status_code=400, detail="Invalid session ID")
+    
+    questions = [q for q in request.questions if q and q.strip()]
+    if not questions:
+        raise HTTPException(status_code=400, detail="No questions provided")
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUESTIONS} questions per batch")
+    
+    formatted_history = ""
+    if request.include_history:
+        formatted_history = format_chat_history(get_memory(session_id))
+    
+    touch_session(session_id)
+    claim_prefetch(session_id)
+    logger.info(f"Answering batch of {len(questions)} questions for session {session_id}")
+    
+    # Retrieve before the 200 goes out, so index errors are reported as such
+    try:
+        batch = await asyncio.to_thread(prepare_batch, session_id, questions, formatted_history)
+    except Exception as e:
+        logger.error(f"Error preparing batch for session {session_id}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to retrieve context for the batch")
+    
+    def results():
+        try:
+            # Closed explicitly on disconnect, so pending LLM calls are cancelled at once
+            with closing(answer_batch(session_id, questions, batch, request.max_concurrency)) as answers:
+                for result in answers:
+                    yield json.dumps(result) + "\n"
+        except Exception as e:
+            logger.error(f"Batch for session {session_id} failed: {e}")
+            yield json.dumps({"error": "Batch failed"}) + "\n"
+    
+    # Starlette iterates the sync generator in its threadpool
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
 @app.post("/save_regeneration_prompt")
 async def save_regeneration_prompt(session_id: str, message_id: str, prompt: str):
     try:
-        chat_history = get_memory(session_id)
-        for msg in chat_history:
-            if msg['id'] == message_id and msg['type'] == 'AIMessage':
-                msg['regeneration_prompt'] = prompt
-                save_memory(session_id, chat_history)
-                return {"success": True}
-        return {"success": False, "error": "Message not found"}
+        try:
+            patch_memory(session_id, [{"op": "set_regeneration_prompt", "message_id": message_id, "prompt": prompt}])
+        except ValueError:
+            return {"success": False, "error": "Message not found"}
+        return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -437,16 +643,6 @@ async def add_web_links(request: WebLinksInput):
 
         scraped_urls = []
         failed_urls = []
-        metadata_path = os.path.join(MEMORY_DIR, f"{session_id}_files.json")
-        file_metadata = {}
-
-        # Load existing metadata if available
-        if os.path.exists(metadata_path):
-            try:
-                with open(metadata_path, "r") as f:
-                    file_metadata = json.load(f)
-            except:
-                pass
 
         for url in urls:
             try:
@@ -475,17 +671,33 @@ async def add_web_links(request: WebLinksInput):
                 filename = f"{domain}_{datetime.now().strftime('%Y%m%d%H%M%S')}.txt"
                 file_path = upload_dir / filename
                 
+                quota_error = check_quota(session_id, filename, len(clean_text.encode("utf-8")))
+                if quota_error:
+                    logger.warning(f"Skipping {url} for session {session_id}: {quota_error}")
+                    failed_urls.append(url)
+                    continue
+                
+                # Save content (compressed; the stored name carries the codec suffix)
+                stored_path = write_text(str(file_path), f"URL: {url}\n\n{clean_text}")
+                filename = os.path.basename(stored_path)
+                
                 # Save metadata
-                file_metadata[filename] = {
-                    "original_url": url,
-                    "type": "webpage",
-                    "scraped_at": datetime.now().isoformat()
-                }
-
-                # Save content
-                with open(file_path, "w", encoding="utf-8") as f:
-                    f.write(f"URL: {url}\n\n")
-                    f.write(clean_text)
+                manifest = record_file(
+                    session_id,
+                    filename,
+                    original_url=url,
+                    type="webpage",
+                    scraped_at=datetime.now().isoformat()
+                )
+                
+                # A re-scrape replaces the earlier copy of the page, letting the
+                # indexer reuse embeddings of the paragraphs that did not change
+                for old_name, entry in manifest["files"].items():
+                    if old_name != filename and entry.get("original_url") == url:
+                        old_path = upload_dir / old_name
+                        if old_path.exists():
+                            old_path.unlink()
+                        remove_file(session_id, old_name)
                 
                 scraped_urls.append({
                     "url": url,
@@ -497,10 +709,6 @@ async def add_web_links(request: WebLinksInput):
                 logger.error(f"Error scraping {url}: {e}")
                 failed_urls.append(url)
 
-        # Save metadata
-        with open(metadata_path, "w") as f:
-            json.dump(file_metadata, f, indent=2)
-        
         result = {"success": len(scraped_urls) > 0}
         if scraped_urls:
             result["scraped_urls"] = scraped_urls
@@ -538,6 +746,11 @@ async def upload_files(
                 failed_files.append("Unnamed file")
                 continue
                 
+            # <file>.ocr.txt names belong to OCR output, which the indexer prefers over <file>
+            if is_ocr_sidecar(file.filename):
+                failed_files.append(f"{file.filename} (reserved file name)")
+                continue
+                
             try:
                 file_path = upload_dir / file.filename
                 
@@ -547,9 +760,20 @@ async def upload_files(
                     failed_files.append(f"{file.filename} (too large)")
                     continue
                 
+                # Enforce per-session file count and storage caps
+                quota_error = check_quota(session_id, file.filename, len(content))
+                if quota_error:
+                    failed_files.append(f"{file.filename} ({quota_error})")
+                    continue
+                
                 # Write file
                 with open(file_path, "wb") as f:
                     f.write(content)
+                discard_sidecar(file_path)
+                record_file(session_id, file.filename)
+                
+                # OCR images and scanned PDFs in the background
+                schedule_ocr(session_id, file.filename)
                     
                 uploaded_files.append(file.filename)
                 logger.info(f"Uploaded file: {file.filename} for session {session_id}")
@@ -572,6 +796,114 @@ async def upload_files(
         logger.error(f"Error in upload endpoint: {e}")
         raise HTTPException(status_code=500, detail="Failed to upload files")
 
+@app.post("/library/upload")
+async def upload_library_files(request: Request, files: List[UploadFile] = File(...)):
+    """Add files to the shared library; its index is rebuilt once on next use."""
+    try:
+        require_library_admin(request)
+        
+        if not files:
+            raise HTTPException(status_code=400, detail="No files provided")
+
+        uploaded_files = []
+        failed_files = []
+
+        for file in files:
+            if not file.filename:
+                failed_files.append("Unnamed file")
+                continue
+                
+            try:
+                safe_filename = os.path.basename(file.filename)
+                content = await file.read()
+                if len(content) > 10 * 1024 * 1024:  # 10MB
+                    failed_files.append(f"{file.filename} (too large)")
+                    continue
+                
+                with open(os.path.join(LIBRARY_DIR, safe_filename), "wb") as f:
+                    f.write(content)
+                    
+                uploaded_files.append(safe_filename)
+                logger.info(f"Uploaded library file: {safe_filename}")
+                
+            except Exception as e:
+                logger.error(f"Error uploading library file {file.filename}: {e}")
+                failed_files.append(f"{file.filename} (upload failed)")
+
+        result = {"success": len(uploaded_files) > 0}
+        if uploaded_files:
+            result["uploaded_files"] = uploaded_files
+        if failed_files:
+            result["failed_files"] = failed_files
+
+        return result
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in library upload endpoint: {e}")
+        raise HTTPException(status_code=500, detail="Failed to upload library files")
+
+@app.get("/library/files")
+async def list_library_files():
+    """List documents in the shared library."""
+    try:
+        files = []
+        for entry in os.scandir(LIBRARY_DIR):
+            if entry.is_file() and not entry.name.startswith('.'):
+                file_stat = entry.stat()
+                files.append({
+                    "name": entry.name,
+                    "size": file_stat.st_size,
+                    "human_size": human_readable_size(file_stat.st_size),
+                    "modified": file_stat.st_mtime
+                })
+        files.sort(key=lambda x: x["modified"], reverse=True)
+        return {"files": files}
+    except Exception as e:
+        logger.error(f"Error listing library files: {e}")
+        raise HTTPException(status_code=500, detail="Failed to list library files")
+
+@app.delete("/library/delete_file")
+async def delete_library_file(filename: str, request: Request):
+    """Remove a document from the shared library."""
+    try:
+        require_library_admin(request)
+        
+        # Sanitize filename to prevent path traversal
+        safe_filename = os.path.basename(filename or "")
+        file_path = os.path.join(LIBRARY_DIR, safe_filename)
+        if not safe_filename or not os.path.exists(file_path):
+            raise HTTPException(status_code=404, detail="File not found")
+        
+        os.remove(file_path)
+        logger.info(f"Deleted library file: {safe_filename}")
+        return {"success": True, "message": f"File '{safe_filename}' deleted successfully"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error deleting library file: {e}")
+        raise HTTPException(status_code=500, detail="Failed to delete library file")
+
+@app.post("/attach_library")
+async def attach_library(request: AttachLibraryRequest):
+    """Attach or detach the shared library for a session."""
+    try:
+        if not request.session_id or not request.session_id.strip():
+            raise HTTPException(status_code=400, detail="Invalid session ID")
+        
+        set_library_attached(request.session_id, request.attached)
+        return {
+            "success": True,
+            "session_id": request.session_id,
+            "library_attached": is_library_attached(request.session_id)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error attaching library: {e}")
+        raise HTTPException(status_code=500, detail="Failed to update library attachment")
+
 @app.post("/select_alternative")
 async def select_alternative(request: dict):
     """Select a specific alternative response."""
@@ -592,9 +924,11 @@ async def select_alternative(request: dict):
                 message.get('alternatives')):
                 
                 if 0 <= alternative_index < len(message['alternatives']):
-                    message['active_index'] = alternative_index
-                    message['content'] = message['alternatives'][alternative_index]
-                    save_memory(session_id, chat_history)
+                    patch_memory(session_id, [{
+                        "op": "select_alternative",
+                        "message_id": message_id,
+                        "index": alternative_index
+                    }])
                     return {"success": True}
                 else:
                     raise HTTPException(status_code=400, detail="Invalid alternative index")
@@ -616,13 +950,52 @@ async def list_sessions():
         raise HTTPException(status_code=500, detail="Failed to retrieve sessions")
 
 @app.get("/chat_history")
-async def get_chat_history(session_id: str):
+async def get_chat_history(
+    session_id: str,
+    limit: Optional[int] = None,
+    before: Optional[str] = None,
+    since: Optional[str] = None
+):
+    """Return chat history: all of it, one page, or only what is new.
+
+    - no paging parameters: the whole history (unchanged behaviour)
+    - limit [+ before]: newest `limit` messages preceding the `before` cursor;
+      `next_cursor` fetches the page before that
+    - since: messages after the given message id; `reset` is true (and the
+      whole history is returned) when that id is unknown
+    """
     try:
         if not session_id or not session_id.strip():
             raise HTTPException(status_code=400, detail="Invalid session ID")
 
         chat_history = get_memory(session_id)
         
+        # Opening a session reads its history first; delta polls do not count
+        if since is None:
+            prefetch_session(session_id)
+        
+        if since is not None:
+            delta = history_since(chat_history, since)
+            return {
+                "history": chat_history if delta is None else delta,
+                "session_id": session_id,
+                "reset": delta is None
+            }
+        
+        if limit is not None or before is not None:
+            if limit is not None and limit <= 0:
+                raise HTTPException(status_code=400, detail="limit must be positive")
+            try:
+                page, next_cursor = page_history(chat_history, limit or 50, before)
+            except ValueError:
+                raise HTTPException(status_code=404, detail="Cursor message not found")
+            return {
+                "history": page,
+                "session_id": session_id,
+                "next_cursor": next_cursor,
+                "has_more": next_cursor is not None
+            }
+        
         if not chat_history:
             return {"history": [], "session_id": session_id}
         
@@ -636,41 +1009,35 @@ async def get_chat_history(session_id: str):
         logger.error(f"Error retrieving chat history: {e}")
         raise HTTPException(status_code=500, detail="Failed to retrieve chat history")
 
-@app.post("/update_chat_history")
-async def update_chat_history(request: dict):
-    """Update chat history with new alternatives."""
+@app.patch("/chat_history")
+async def patch_chat_history(request: PatchChatHistoryRequest):
+    """Apply individual message edits and alternative changes to the chat history.
+
+    Replaces /update_chat_history: the client sends only the changed
+    messages as operations (see memory_store.apply_history_operations)
+    instead of the full message list.
+    """
     try:
-        session_id = request.get('session_id')
-        frontend_messages = request.get('messages', [])
+        if not request.session_id or not request.session_id.strip():
+            raise HTTPException(status_code=400, detail="Invalid session ID")
         
-        if not session_id:
-            raise HTTPException(status_code=400, detail="Session ID required")
+        if not request.operations:
+            raise HTTPException(status_code=400, detail="No operations provided")
         
-        # Convert frontend messages back to storage format
-        chat_history = []
-        for msg in frontend_messages:
-            if msg['sender'] == 'user':
-                chat_history.append({
-                    'content': msg['text'],
-                    'type': 'HumanMessage',
-                    'alternatives': [],
-                    'active_index': 0,
-                    'id': msg['id']
-                })
-            else:  # bot
-                chat_history.append({
-                    'content': msg['text'],
-                    'type': 'AIMessage',
-                    'alternatives': msg.get('alternatives', [msg['text']]),
-                    'active_index': msg.get('activeIndex', 0),
-                    'id': msg['id']
-                })
+        try:
+            # Ids are fixed here so the client can address the messages it appended
+            operations = assign_message_ids(request.operations)
+            chat_history = patch_memory(request.session_id, operations)
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid operation: {e}")
         
-        save_memory(session_id, chat_history)
-        return {"success": True}
+        appended_ids = [operation["message"]["id"] for operation in operations if operation.get("op") == "append"]
+        return {"success": True, "message_count": len(chat_history), "appended_ids": appended_ids}
         
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Error updating chat history: {e}")
+        logger.error(f"Error patching chat history: {e}")
         raise HTTPException(status_code=500, detail="Failed to update chat history")
     
 @app.put("/update_session_title")
@@ -705,29 +1072,10 @@ async def delete_session(session_id: str):
         if not session_id or not session_id.strip():
             raise HTTPException(status_code=400, detail="Invalid session ID")
 
-        # Delete memory file
-        try:
-            clear_memory(session_id)
-        except Exception as e:
-            logger.warning(f"Error clearing memory for session {session_id}: {e}")
-        
-        # Delete session metadata
-        try:
-            metadata_path = os.path.join(MEMORY_DIR, f"{session_id}_metadata.json")
-            if os.path.exists(metadata_path):
-                os.remove(metadata_path)
-        except Exception as e:
-            logger.warning(f"Error deleting metadata for session {session_id}: {e}")
-        
-        # Delete uploaded documents
-        try:
-            doc_dir = os.path.join(UPLOAD_DIR, session_id)
-            if os.path.exists(doc_dir):
-                shutil.rmtree(doc_dir)
-        except Exception as e:
-            logger.warning(f"Error deleting documents for session {session_id}: {e}")
+        # Delete memory, metadata, uploaded documents and stored index
+        freed = purge_session(session_id)
         
-        logger.info(f"Deleted session: {session_id}")
+        logger.info(f"Deleted session: {session_id} ({human_readable_size(freed)} freed)")
         return {"success": True, "session_id": session_id}
         
     except HTTPException:
@@ -736,6 +1084,66 @@ async def delete_session(session_id: str):
         logger.error(f"Error deleting session: {e}")
         raise HTTPException(status_code=500, detail="Failed to delete session")
 
+@app.get("/export_session")
+async def export_session_snapshot(session_id: str):
+    """Download a session (files, parsed text, index, history, metadata) as one archive."""
+    try:
+        if not session_id or not session_id.strip() or session_id != os.path.basename(session_id):
+            raise HTTPException(status_code=400, detail="Invalid session ID")
+        
+        try:
+            archive_path = await asyncio.to_thread(export_session, session_id)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="Session not found")
+        
+        return FileResponse(
+            archive_path,
+            media_type="application/gzip",
+            filename=f"session_{session_id}.tar.gz",
+            background=BackgroundTask(os.remove, archive_path)
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error exporting session: {e}")
+        raise HTTPException(status_code=500, detail="Failed to export session")
+
+@app.post("/import_session")
+async def import_session_snapshot(
+    file: UploadFile = File(...),
+    session_id: Optional[str] = Form(None),
+    overwrite: bool = Form(False)
+):
+    """Restore a session from an /export_session archive, ready to chat without re-indexing."""
+    archive_path = os.path.join(SNAPSHOT_DIR, f".upload-{uuid.uuid4().hex}.tar.gz")
+    try:
+        # Spool the upload to disk in blocks rather than holding it in memory
+        size = 0
+        with open(archive_path, "wb") as f:
+            while block := await file.read(1024 * 1024):
+                size += len(block)
+                if size > MAX_SNAPSHOT_BYTES:
+                    raise HTTPException(status_code=413, detail="Snapshot too large")
+                f.write(block)
+        
+        try:
+            result = await asyncio.to_thread(import_session, archive_path, session_id, overwrite)
+        except FileExistsError:
+            raise HTTPException(status_code=409, detail="Session already exists")
+        except (ValueError, KeyError, tarfile.TarError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid snapshot: {e}")
+        
+        touch_session(result["session_id"])
+        return {"success": True, **result}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error importing session: {e}")
+        raise HTTPException(status_code=500, detail="Failed to import session")
+    finally:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+
 @app.delete("/delete_file")
 async def delete_file(request: DeleteFileRequest):
     """Delete a specific file from a session."""
@@ -758,6 +1166,8 @@ async def delete_file(request: DeleteFileRequest):
         
         # Delete the file
         os.remove(file_path)
+        discard_sidecar(file_path)
+        remove_file(request.session_id, safe_filename)
         
         logger.info(f"Deleted file: {safe_filename} from session {request.session_id}")
         return {
@@ -772,7 +1182,7 @@ async def delete_file(request: DeleteFileRequest):
         raise HTTPException(status_code=500, detail="Failed to delete file")
 
 @app.get("/uploaded_files")
-async def get_uploaded_files(session_id: str):
+async def get_uploaded_files(session_id: str, request: Request):
     """List uploaded files and web links for a given session with metadata."""
     try:
         if not session_id or not session_id.strip():
@@ -782,90 +1192,66 @@ async def get_uploaded_files(session_id: str):
         if not os.path.exists(doc_dir):
             return {"files": []}
         
-        # Load file metadata
-        metadata_path = os.path.join(MEMORY_DIR, f"{session_id}_files.json")
-        file_metadata = {}
-        if os.path.exists(metadata_path):
-            try:
-                with open(metadata_path, "r") as f:
-                    file_metadata = json.load(f)
-            except Exception as e:
-                logger.error(f"Error loading file metadata: {e}")
-
-        files = []
-        
-        # First pass: collect all non-OCR files and note OCR status
-        for entry in os.scandir(doc_dir):
-            if entry.is_file():
-                # Skip OCR-generated files (*.ocr.txt)
-                if entry.name.endswith('.ocr.txt'):
-                    continue
-                    
-                try:
-                    file_stat = entry.stat()
-                    base_name = entry.name
-                    
-                    # Check if this file has metadata (web scraped content)
-                    file_info = file_metadata.get(base_name, {})
-                    
-                    # Create file entry
-                    file_entry = {
-                        "name": base_name,
-                        "display_name": file_info.get("original_url", base_name),
-                        "original_url": file_info.get("original_url", None),
-                        "type": file_info.get("type", "file"),
-                        "size": file_stat.st_size,
-                        "human_size": human_readable_size(file_stat.st_size),
-                        "modified": file_stat.st_mtime,
-                        "modified_iso": datetime.fromtimestamp(file_stat.st_mtime).isoformat(),
-                        "extension": os.path.splitext(base_name)[1].lower(),
-                        "is_image": is_image_file(base_name),
-                        "ocr_processed": False  # Will check below
-                    }
-                    
-                    # Check if OCR file exists for this file
-                    if file_entry["is_image"] or base_name.lower().endswith('.pdf'):
-                        ocr_file = os.path.join(doc_dir, f"{base_name}.ocr.txt")
-                        file_entry["ocr_processed"] = os.path.exists(ocr_file)
-                    
-                    files.append(file_entry)
-                except Exception as e:
-                    logger.warning(f"Error processing {entry.name}: {e}")
-                    files.append({
-                        "name": entry.name,
-                        "display_name": entry.name,
-                        "error": str(e)
-                    })
+        # One read of the manifest maintained by upload, scrape, delete and OCR
+        manifest = read_manifest(session_id)
+        etag = manifest_etag(manifest)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
 
-        # Sort files by modification time (newest first)
-        files.sort(key=lambda x: x.get("modified", 0), reverse=True)
+        # Unchanged listing: let the client reuse its copy
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
         
-        return {"files": files}
+        prefetch_session(session_id)
+        # chunks.truncated tells the user that documents past MAX_CHUNKS_PER_SESSION are not searched
+        return JSONResponse(content={"files": list_files(manifest), "chunks": manifest.get("chunks")}, headers=headers)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error listing files: {e}")
         raise HTTPException(status_code=500, detail="Failed to list files")
 
-# Helper functions (add outside endpoint)
-def human_readable_size(size_bytes):
-    """Convert bytes to human-readable format"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if size_bytes < 1024:
-            return f"{size_bytes:.1f} {unit}"
-        size_bytes /= 1024
-    return f"{size_bytes:.1f} TB"
+@app.get("/profiles")
+async def get_profiles(request: Request):
+    """List stored request profiles, newest first."""
+    require_profile_admin(request)
+    return {"profiles": list_profiles()}
 
-def is_image_file(filename):
-    """Check if file is an image"""
-    image_exts = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
-    return os.path.splitext(filename)[1].lower() in image_exts
+@app.get("/profiles/{request_id}")
+async def get_profile(request_id: str, request: Request, format: str = "json"):
+    """Return one request's profile; format=folded gives flame graph input."""
+    require_profile_admin(request)
+    profile = read_profile(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "folded":
+        folded = "\n".join(f"{stack} {count}" for stack, count in profile["cpu"]["folded"].items())
+        return PlainTextResponse(folded + "\n")
+    return profile
 
 @app.get("/health")
 async def health_check():
     """Simple health check endpoint."""
     return {"status": "healthy", "message": "FastAPI server is running"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Report counters for duplicate work avoided by request coalescing."""
+    return {
+        "singleflight": {
+            "chain_build": chain_builds.stats(),
+            "llm_invoke": llm_calls.stats()
+        },
+        "indexing": get_indexing_stats(),
+        "query_embedding_cache": get_query_cache_stats(),
+        "context_packing": get_packing_stats(),
+        "janitor": get_janitor_stats(),
+        "ocr": get_ocr_stats(),
+        "storage": get_storage_stats(),
+        "prefetch": get_prefetch_stats(),
+        "profiling": get_profiler_stats(),
+        "query_router": get_router_stats()
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
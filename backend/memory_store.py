@@ -1,10 +1,20 @@
 import os
 import json
+import uuid
+import fcntl
+from contextlib import contextmanager
 from datetime import datetime
+import storage_codec
 
 # Directory to store session memory
 MEMORY_DIR = "session_memory"
 
+# Patch operations journaled before they are folded into the history file
+HISTORY_COMPACT_AFTER = int(os.getenv("HISTORY_COMPACT_AFTER", "50"))
+
+# Per-session files in MEMORY_DIR other than the history itself (<session_id>.json)
+SESSION_SIDECAR_SUFFIXES = ("_metadata.json", "_files.json", "_files.lock", ".patch.jsonl", ".history.lock")
+
 # Ensure the memory directory exists
 os.makedirs(MEMORY_DIR, exist_ok=True)
 
@@ -12,33 +22,203 @@ def get_memory_path(session_id):
     """Get the file path for storing session memory."""
     return os.path.join(MEMORY_DIR, f"{session_id}.json")
 
+def get_patch_log_path(session_id):
+    """Get the file path of the session's journal of history patches."""
+    return os.path.join(MEMORY_DIR, f"{session_id}.patch.jsonl")
+
+def get_history_lock_path(session_id):
+    """Get the lock file serializing writes to a session's history and journal."""
+    return os.path.join(MEMORY_DIR, f"{session_id}.history.lock")
+
+@contextmanager
+def _history_locked(session_id):
+    with open(get_history_lock_path(session_id), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 def get_metadata_path(session_id):
     """Get the file path for storing session metadata."""
     return os.path.join(MEMORY_DIR, f"{session_id}_metadata.json")
 
+def _read_patch_log(session_id):
+    """Return the journaled patch batches for a session, oldest first."""
+    patch_path = get_patch_log_path(session_id)
+    batches = []
+    if os.path.exists(patch_path):
+        try:
+            with open(patch_path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        batches.append(json.loads(line))
+        except Exception as e:
+            print(f"Error loading history patches: {e}")
+    return batches
+
 def get_memory(session_id):
     """Retrieve chat history from memory for a session."""
     memory_path = get_memory_path(session_id)
+    chat_history = []
     
-    if os.path.exists(memory_path):
+    if storage_codec.exists(memory_path):
         try:
-            with open(memory_path, "r") as f:
-                return json.load(f)
+            chat_history = storage_codec.load_json(memory_path)
         except Exception as e:
             print(f"Error loading memory: {e}")
     
-    return []
+    # Replay patches not yet compacted into the history file
+    for operations in _read_patch_log(session_id):
+        try:
+            apply_history_operations(chat_history, operations)
+        except ValueError as e:
+            print(f"Skipping invalid history patch: {e}")
+    
+    return chat_history
+
+def _write_history(session_id, chat_history):
+    """Replace the history file and drop the journal it now includes (history lock held)."""
+    # Stored compressed, so indentation would only cost CPU
+    storage_codec.write_text(get_memory_path(session_id), json.dumps(chat_history))
+    patch_path = get_patch_log_path(session_id)
+    if os.path.exists(patch_path):
+        os.remove(patch_path)
 
 def save_memory(session_id, chat_history):
-    """Save chat history to memory for a session with improved structure."""
-    memory_path = get_memory_path(session_id)
-    
+    """Save chat history to memory for a session with improved structure.
+
+    This replaces the whole history, discarding patches journaled since
+    chat_history was read; callers that hold a history across slow work
+    (e.g. an LLM call) should record their changes with patch_memory.
+    """
     try:
-        with open(memory_path, "w") as f:
-            json.dump(chat_history, f, indent=2)
+        with _history_locked(session_id):
+            _write_history(session_id, chat_history)
     except Exception as e:
         print(f"Error saving memory: {e}")
 
+def _find_message(chat_history, message_id):
+    for message in chat_history:
+        if message.get('id') == message_id:
+            return message
+    raise ValueError(f"Message {message_id} not found")
+
+def apply_history_operations(chat_history, operations):
+    """Apply patch operations to a chat history list in place.
+
+    Supported operations (each a dict with an "op" key):
+      append             {"message": {...}}
+      edit               {"message_id", "content"}
+      add_alternative    {"message_id", "content", ["regeneration": true]}
+      select_alternative {"message_id", "index"}
+      set_alternatives   {"message_id", "alternatives", "active_index"}
+      set_regeneration_prompt {"message_id", "prompt"}  (AI messages only)
+      delete             {"message_id"}
+    Raises ValueError on an unknown operation, message or index.
+    """
+    for operation in operations:
+        op = operation.get('op')
+        if op == 'append':
+            message = dict(operation.get('message') or {})
+            if message.get('type') not in ('HumanMessage', 'AIMessage') or 'content' not in message:
+                raise ValueError("append requires a message with type and content")
+            message.setdefault('id', str(uuid.uuid4()))
+            message.setdefault('timestamp', datetime.now().isoformat())
+            if message['type'] == 'AIMessage':
+                message.setdefault('alternatives', [message['content']])
+                message.setdefault('active_index', 0)
+            chat_history.append(message)
+        elif op == 'delete':
+            chat_history.remove(_find_message(chat_history, operation.get('message_id')))
+        elif op == 'set_regeneration_prompt':
+            message = _find_message(chat_history, operation.get('message_id'))
+            if message.get('type') != 'AIMessage':
+                raise ValueError("Regeneration prompts can only be set on AI messages")
+            message['regeneration_prompt'] = operation['prompt']
+        elif op in ('edit', 'add_alternative', 'select_alternative', 'set_alternatives'):
+            message = _find_message(chat_history, operation.get('message_id'))
+            if op == 'edit':
+                message['content'] = operation['content']
+                if message.get('alternatives'):
+                    message['alternatives'][message.get('active_index', 0)] = operation['content']
+            elif op == 'add_alternative':
+                message.setdefault('alternatives', [message['content']]).append(operation['content'])
+                message['active_index'] = len(message['alternatives']) - 1
+                message['content'] = operation['content']
+                if operation.get('regeneration'):
+                    message['regeneration_count'] = message.get('regeneration_count', 0) + 1
+            else:
+                alternatives = operation['alternatives'] if op == 'set_alternatives' else message.get('alternatives', [])
+                index = operation.get('index', operation.get('active_index', 0))
+                if not 0 <= index < len(alternatives):
+                    raise ValueError("Invalid alternative index")
+                message['alternatives'] = alternatives
+                message['active_index'] = index
+                message['content'] = alternatives[index]
+        else:
+            raise ValueError(f"Unknown operation: {op}")
+    return chat_history
+
+def assign_message_ids(operations):
+    """Return operations with an id and timestamp filled in on every appended message.
+
+    Journaled operations are replayed on each read, so anything generated
+    while applying them must be fixed before they are written.
+    """
+    assigned = []
+    for operation in operations:
+        if operation.get('op') == 'append' and isinstance(operation.get('message'), dict):
+            message = dict(operation['message'])
+            message.setdefault('id', str(uuid.uuid4()))
+            message.setdefault('timestamp', datetime.now().isoformat())
+            operation = dict(operation, message=message)
+        assigned.append(operation)
+    return assigned
+
+def patch_memory(session_id, operations):
+    """Validate and journal history patch operations; returns the patched history.
+
+    Each call appends one line to the session's patch journal, so the write
+    cost follows the size of the change. The journal is folded into the
+    history file once it holds HISTORY_COMPACT_AFTER batches.
+    """
+    operations = assign_message_ids(operations)
+    # Read, validate and journal under one lock so compaction never drops a concurrent patch
+    with _history_locked(session_id):
+        chat_history = apply_history_operations(get_memory(session_id), operations)
+        
+        if len(_read_patch_log(session_id)) + 1 >= HISTORY_COMPACT_AFTER:
+            _write_history(session_id, chat_history)
+            return chat_history
+        
+        with open(get_patch_log_path(session_id), "a") as f:
+            f.write(json.dumps(operations) + "\n")
+    return chat_history
+
+def page_history(chat_history, limit, before=None):
+    """Return up to `limit` messages preceding the `before` message id (newest page if None).
+
+    Returns (messages, next_cursor) where next_cursor is the id to pass as
+    `before` for the previous page, or None when the start was reached.
+    """
+    end = len(chat_history)
+    if before is not None:
+        end = next((i for i, message in enumerate(chat_history) if message.get('id') == before), None)
+        if end is None:
+            raise ValueError(f"Message {before} not found")
+    start = max(0, end - limit)
+    page = chat_history[start:end]
+    return page, (page[0].get('id') if start > 0 and page else None)
+
+def history_since(chat_history, message_id):
+    """Return messages after the given message id, or None if the id is unknown."""
+    for i, message in enumerate(chat_history):
+        if message.get('id') == message_id:
+            return chat_history[i + 1:]
+    return None
+
 def save_session_metadata(session_id, title):
     """Save session metadata including title and creation time."""
     metadata_path = get_metadata_path(session_id)
@@ -69,6 +249,28 @@ def save_session_metadata(session_id, title):
     except Exception as e:
         print(f"Error saving metadata: {e}")
 
+def update_session_metadata(session_id, **fields):
+    """Set additional session metadata fields, keeping title and timestamps."""
+    metadata_path = get_metadata_path(session_id)
+    
+    metadata = {}
+    if os.path.exists(metadata_path):
+        try:
+            with open(metadata_path, "r") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            print(f"Error loading existing metadata: {e}")
+    
+    metadata.update(fields)
+    metadata["last_updated"] = datetime.now().isoformat()
+    metadata.setdefault("created_at", metadata["last_updated"])
+    
+    try:
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f, indent=2)
+    except Exception as e:
+        print(f"Error saving metadata: {e}")
+
 def get_session_metadata(session_id):
     """Retrieve session metadata."""
     metadata_path = get_metadata_path(session_id)
@@ -93,10 +295,14 @@ def get_all_sessions_metadata():
     
     try:
         # Get all session files
-        memory_files = [f for f in os.listdir(MEMORY_DIR) if f.endswith('.json') and not f.endswith('_metadata.json')]
+        memory_files = [storage_codec.strip_codec_suffix(f) for f in os.listdir(MEMORY_DIR)]
+        memory_files = [
+            f for f in memory_files
+            if f.endswith('.json') and not f.endswith(SESSION_SIDECAR_SUFFIXES)
+        ]
         
         for memory_file in memory_files:
-            session_id = memory_file.replace('.json', '')
+            session_id = memory_file[:-len('.json')]
             metadata = get_session_metadata(session_id)
             sessions.append(metadata)
         
@@ -122,7 +328,7 @@ def format_chat_history(chat_history):
 
 def clear_memory(session_id):
     """Delete the memory file for a given session."""
-    memory_path = get_memory_path(session_id)
-    
-    if os.path.exists(memory_path):
-        os.remove(memory_path)
\ No newline at end of file
+    storage_codec.remove(get_memory_path(session_id))
+    patch_path = get_patch_log_path(session_id)
+    if os.path.exists(patch_path):
+        os.remove(patch_path)
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""Background OCR for uploaded images and scanned PDFs.
+
+Uploads schedule OCR in a worker pool so requests never wait on it. Each
+result is cached under OCR_CACHE_DIR by the SHA-256 of the file's bytes and
+written next to the upload as <file>.ocr.txt, which the indexer reads in
+place of the original. Identical files, in any session, are OCR'd once.
+
+Only a local engine is used (Tesseract via pytesseract, with pdf2image for
+PDFs); when those packages are missing OCR is skipped and files are indexed
+as before. PDFs are only OCR'd when pypdf is available to confirm they lack
+a usable text layer, so a missing pypdf never replaces good text with OCR.
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from file_manifest import is_image_file, needs_ocr, set_ocr_processed
+import storage_codec
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploaded_docs"
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "ocr_cache")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+OCR_LANGUAGE = os.getenv("OCR_LANGUAGE", "eng")
+# PDFs whose text layer yields at least this many characters per page are not OCR'd
+OCR_MIN_PDF_CHARS_PER_PAGE = int(os.getenv("OCR_MIN_PDF_CHARS_PER_PAGE", "100"))
+
+os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+
+_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+# (session_id, filename) -> whether the file was re-uploaded while its job was pending
+_pending = {}
+_pending_lock = threading.Lock()
+
+_stats = {"scheduled": 0, "cache_hits": 0, "ocr_runs": 0, "skipped": 0, "failed": 0}
+
+def get_sidecar_path(file_path):
+    """Get the OCR text sidecar path for an uploaded file."""
+    return f"{file_path}.ocr.txt"
+
+def discard_sidecar(file_path):
+    """Remove a stale sidecar when its file is replaced or deleted."""
+    storage_codec.remove(get_sidecar_path(file_path))
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _has_text_layer(path):
+    """Check whether a PDF already carries enough extractable text."""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        # Cannot tell, so keep the PDF's own text rather than OCR over it
+        logger.warning(f"pypdf not installed, not OCR-ing {os.path.basename(path)}")
+        return True
+    reader = PdfReader(path)
+    if not reader.pages:
+        return True
+    chars = sum(len(page.extract_text() or "") for page in reader.pages)
+    return chars / len(reader.pages) >= OCR_MIN_PDF_CHARS_PER_PAGE
+
+def _run_ocr(path):
+    """Extract text with the local Tesseract engine."""
+    import pytesseract
+    from PIL import Image
+
+    if is_image_file(path):
+        with Image.open(path) as image:
+            return pytesseract.image_to_string(image, lang=OCR_LANGUAGE)
+
+    from pdf2image import convert_from_path
+    pages = convert_from_path(path)
+    return "\n\n".join(pytesseract.image_to_string(page, lang=OCR_LANGUAGE) for page in pages)
+
+def _process(session_id, filename):
+    path = os.path.join(UPLOAD_DIR, session_id, filename)
+    try:
+        if not os.path.exists(path):
+            return
+
+        # A re-upload while OCR runs is not queued again (the job is pending),
+        # so redo the work until the sidecar matches the file's current bytes
+        while True:
+            file_hash = _file_hash(path)
+            cache_path = os.path.join(OCR_CACHE_DIR, f"{file_hash}.txt")
+            if storage_codec.exists(cache_path):
+                _stats["cache_hits"] += 1
+                text = storage_codec.read_text(cache_path)
+            elif filename.lower().endswith('.pdf') and _has_text_layer(path):
+                text = None
+            else:
+                text = _run_ocr(path)
+                storage_codec.write_text(cache_path, text)
+                _stats["ocr_runs"] += 1
+
+            if text is not None:
+                # Written atomically under a hidden temp name, so loaders never see a partial sidecar
+                storage_codec.write_text(get_sidecar_path(path), text)
+            if _file_hash(path) == file_hash:
+                break
+            logger.info(f"{filename} in session {session_id} changed during OCR, redoing it")
+            discard_sidecar(path)
+
+        if text is None:
+            _stats["skipped"] += 1
+            return
+
+        set_ocr_processed(session_id, filename)
+        logger.info(f"OCR text ready for {filename} in session {session_id}")
+    except ImportError as e:
+        _stats["skipped"] += 1
+        logger.warning(f"Local OCR engine unavailable, skipping {filename}: {e}")
+    except Exception as e:
+        _stats["failed"] += 1
+        logger.error(f"OCR failed for {filename} in session {session_id}: {e}")
+    finally:
+        key = (session_id, filename)
+        with _pending_lock:
+            rerun = _pending.pop(key, False)
+            if rerun:
+                _pending[key] = False
+        if rerun:
+            _executor.submit(_process, session_id, filename)
+
+def schedule_ocr(session_id, filename):
+    """Queue OCR for an uploaded image or PDF; returns False if not applicable."""
+    if not needs_ocr(filename):
+        return False
+    key = (session_id, filename)
+    with _pending_lock:
+        if key in _pending:
+            # Let the running job pick up the new bytes once it finishes
+            _pending[key] = True
+            return True
+        _pending[key] = False
+    _stats["scheduled"] += 1
+    _executor.submit(_process, session_id, filename)
+    return True
+
+def shutdown_ocr():
+    """Stop accepting OCR work; queued jobs are dropped."""
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+def get_ocr_stats():
+    """Return OCR stage counters."""
+    with _pending_lock:
+        pending = len(_pending)
+    return dict(_stats, pending=pending)
@@ -0,0 +1,148 @@
+"""Route chat turns that need no document retrieval straight to the LLM.
+
+Greetings, thanks, name introductions and other small talk, and questions
+about the conversation itself ("what's my name?", "summarize our chat"),
+are answered from the chat history alone, with a prompt that does not
+deny the session's documents exist. route_query classifies a message
+with cheap rules, so these turns skip document loading, query embedding and
+vector search. Anything not clearly matched goes to retrieval.
+
+Each decision is logged with the rule that matched, and record_latency keeps
+per-route averages so /metrics can report the latency saved.
+"""
+import logging
+import os
+import re
+import threading
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+QUERY_ROUTER_ENABLED = os.getenv("QUERY_ROUTER_ENABLED", "true").lower() in ("1", "true", "yes")
+# Longer messages are always sent to retrieval
+ROUTER_MAX_WORDS = int(os.getenv("ROUTER_MAX_WORDS", "12"))
+
+ROUTE_RETRIEVAL = "retrieval"
+ROUTE_SMALL_TALK = "small_talk"
+ROUTE_HISTORY = "history"
+
+_GREETING = r"(hi+|hello+|hey+|hiya|yo|howdy|greetings|good (morning|afternoon|evening|day)|namaste)"
+_SMALL_TALK_PATTERNS = [
+    ("greeting", re.compile(rf"^({_GREETING}( there| everyone| all)?)+$")),
+    ("thanks", re.compile(r"^(thanks?( you)?( so much| a lot| very much)?|thx|ty|cheers|much appreciated|appreciate it)$")),
+    ("farewell", re.compile(r"^(bye+|goodbye|see you( later| soon)?|good night|take care|talk (to you )?later)$")),
+    # Bare yes/no/ok/sure are answers, not small talk, so they are left to retrieval
+    ("acknowledgement", re.compile(r"^(cool|nice|great|awesome|got it|understood|perfect|makes sense)$")),
+    ("how_are_you", re.compile(r"^(how are you( doing)?( today)?|how('s| is) it going|what'?s up|how have you been)$")),
+    ("introduction", re.compile(r"^(my name is|my name'?s|call me) [a-z][a-z'-]*( [a-z][a-z'-]*)?$")),
+    ("about_assistant", re.compile(r"^((who|what) are you|what('s| is) your name|what can you do)$")),
+]
+_HISTORY_PATTERNS = [
+    ("recall_name", re.compile(r"^(what('s| is) my name|do you (know|remember) my name|who am i)$")),
+    ("recall_conversation", re.compile(
+        r"^(what did (i|you) (just )?(say|ask|tell( me)?)|what was my (last |previous |first )?question"
+        r"|what was your (last |previous )?(answer|response)|repeat (that|your (last )?answer)|say that again)$"
+    )),
+    ("summarize_conversation", re.compile(
+        r"^(summari[sz]e|recap) (our|this|the) (conversation|chat|discussion)( so far)?$"
+    )),
+]
+
+_stats_lock = threading.Lock()
+_stats = {
+    "decisions": {ROUTE_RETRIEVAL: 0, ROUTE_SMALL_TALK: 0, ROUTE_HISTORY: 0},
+    "reasons": {},
+    "latency_total": {ROUTE_RETRIEVAL: 0.0, ROUTE_SMALL_TALK: 0.0, ROUTE_HISTORY: 0.0},
+    "latency_count": {ROUTE_RETRIEVAL: 0, ROUTE_SMALL_TALK: 0, ROUTE_HISTORY: 0}
+}
+
+def _normalize(message):
+    text = message.lower().strip()
+    text = re.sub(r"[^\w\s'-]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def _strip_greeting(text):
+    """Remove a leading greeting so "hi, what's my name" is judged on the question."""
+    return re.sub(rf"^({_GREETING}( there)?\s*)+", "", text).strip()
+
+def _last_ai_turn_asked(chat_history):
+    for message in reversed(chat_history or []):
+        if message.get("type") == "AIMessage":
+            return message.get("content", "").rstrip().endswith("?")
+    return False
+
+def route_query(message, chat_history=None):
+    """Classify a chat turn; returns (route, reason).
+
+    route is ROUTE_SMALL_TALK or ROUTE_HISTORY when the turn can be answered
+    without retrieval, and ROUTE_RETRIEVAL otherwise.
+    """
+    if not QUERY_ROUTER_ENABLED:
+        return ROUTE_RETRIEVAL, "disabled"
+    text = _normalize(message)
+    if not text or len(text.split()) > ROUTER_MAX_WORDS:
+        return ROUTE_RETRIEVAL, "default"
+
+    for reason, pattern in _SMALL_TALK_PATTERNS:
+        if pattern.match(text):
+            # "Great" after "Shall I summarize section 2?" accepts the offer
+            if reason == "acknowledgement" and _last_ai_turn_asked(chat_history):
+                return ROUTE_RETRIEVAL, "reply_to_question"
+            return ROUTE_SMALL_TALK, reason
+
+    remainder = _strip_greeting(text)
+    if chat_history and remainder:
+        for reason, pattern in _HISTORY_PATTERNS:
+            if pattern.match(remainder):
+                return ROUTE_HISTORY, reason
+    if remainder and remainder != text:
+        for reason, pattern in _SMALL_TALK_PATTERNS:
+            if pattern.match(remainder):
+                return ROUTE_SMALL_TALK, reason
+
+    return ROUTE_RETRIEVAL, "default"
+
+def needs_retrieval(route):
+    return route == ROUTE_RETRIEVAL
+
+def log_decision(session_id, message, route, reason):
+    """Count and log a routing decision for later accuracy review."""
+    with _stats_lock:
+        _stats["decisions"][route] += 1
+        _stats["reasons"][reason] = _stats["reasons"].get(reason, 0) + 1
+    preview = message if len(message) <= 60 else message[:57] + "..."
+    logger.info(f"Routed message for session {session_id} to {route} ({reason}): {preview!r}")
+
+def record_latency(session_id, route, seconds):
+    """Record how long a routed turn took, logging the estimated saving for skipped retrieval."""
+    with _stats_lock:
+        _stats["latency_total"][route] += seconds
+        _stats["latency_count"][route] += 1
+        retrieval_avg = _average(ROUTE_RETRIEVAL)
+    if not needs_retrieval(route) and retrieval_avg is not None:
+        logger.info(
+            f"Answered {route} turn for session {session_id} in {seconds:.2f}s "
+            f"(retrieval turns average {retrieval_avg:.2f}s, saved ~{max(0.0, retrieval_avg - seconds):.2f}s)"
+        )
+
+def _average(route):
+    count = _stats["latency_count"][route]
+    return _stats["latency_total"][route] / count if count else None
+
+def get_router_stats():
+    """Return route counts, matched rules, average latency per route and the estimated time saved."""
+    with _stats_lock:
+        averages = {route: _average(route) for route in _stats["latency_count"]}
+        retrieval_avg = averages[ROUTE_RETRIEVAL]
+        saved = 0.0
+        if retrieval_avg is not None:
+            for route in (ROUTE_SMALL_TALK, ROUTE_HISTORY):
+                if averages[route] is not None:
+                    saved += max(0.0, retrieval_avg - averages[route]) * _stats["latency_count"][route]
+        return {
+            "enabled": QUERY_ROUTER_ENABLED,
+            "decisions": dict(_stats["decisions"]),
+            "reasons": dict(_stats["reasons"]),
+            "avg_latency_seconds": {route: round(avg, 4) if avg is not None else None for route, avg in averages.items()},
+            "estimated_saved_seconds": round(saved, 3)
+        }
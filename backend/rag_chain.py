@@ -1,58 +1,37 @@
 import logging
-from langchain_community.document_loaders import DirectoryLoader, UnstructuredFileLoader
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.document_loaders import UnstructuredFileLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
-from langchain_groq import ChatGroq
+from langchain_core.documents import Document
+import storage_codec
+from llm_client import get_llm
+from embeddings import get_embedding_model
+import index_store
+from exact_index import normalize_rows
+from context_packer import pack_context
+from document_library import (
+    LIBRARY_DIR, LIBRARY_INDEX_DIR, LIBRARY_MAX_CHUNKS, library_has_documents, is_library_attached,
+    search_merged, MergedRetriever
+)
+from session_janitor import MAX_CHUNKS_PER_SESSION
+from file_manifest import read_manifest, set_chunk_usage, needs_ocr, is_ocr_sidecar, compressed_text_names
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import numpy as np
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
 # Set up logger
 logger = logging.getLogger(__name__)
 
-groq_api_key = os.getenv("GROQ_API_KEY")
-
 UPLOAD_DIR = "uploaded_docs"
 
-def build_chain(session_id):
-    # Define the directory where uploaded files are stored for this session
-    doc_dir = os.path.join(UPLOAD_DIR, session_id)
-    
-    # Check if documents exist for this session
-    if not os.path.exists(doc_dir) or not any(os.scandir(doc_dir)):
-        logger.info(f"No documents found for session {session_id}, using general knowledge mode")
-        return create_general_knowledge_chain()
-    
-    # Load documents from the directory
-    loader = DirectoryLoader(doc_dir)
-    documents = loader.load()
-    
-    # Split documents into chunks
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    splits = text_splitter.split_documents(documents)
-    
-    # Create embeddings and vector store
-    embedding_model = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    vectorstore = FAISS.from_documents(documents=splits, embedding=embedding_model)
-    
-    # Create a retriever
-    retriever = vectorstore.as_retriever()
-    
-    # Define a function to extract the question string from the input
-    def get_query(inputs):
-        if isinstance(inputs, dict) and "question" in inputs:
-            return inputs["question"]
-        elif isinstance(inputs, str):
-            return inputs
-        return str(inputs)
-    
-    # Define the prompt template
-    template = """
+# Upper bound on concurrent LLM calls made by answer_batch
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+# Prompt used when the session has documents to retrieve from
+RAG_TEMPLATE = """
 You are a smart, friendly, and helpful personal assistant. Your task is to chat with the user naturally and answer their questions.
 1. DOCUMENT-BASED ANSWERING: When documents are available, use them to provide accurate answers
 2. GENERAL KNOWLEDGE: When no documents are available or they aren't relevant, use your general knowledge
@@ -68,15 +47,247 @@ Context:
     
 Question: {question}
 """
+
+# Running totals of incremental index maintenance
+_indexing_stats = {"chunks_embedded": 0, "chunks_reused": 0, "chunks_removed": 0}
+
+def _read_stored_text(stored):
+    # Uploads are never rewritten here, so files are read as stored, without migration
+    with storage_codec.open_stored_text(stored) as f:
+        return f.read()
+
+def load_session_documents(doc_dir, compressed_names=()):
+    """Load every document in a directory, preferring cached OCR text sidecars.
+
+    compressed_names lists files this app wrote compressed (scraped pages,
+    per the manifest); every other file is loaded as uploaded, whatever its
+    suffix.
+    """
+    names = {entry.name for entry in os.scandir(doc_dir) if entry.is_file()}
+    documents = []
+    for name in sorted(names):
+        # Hidden temp files and the sidecars themselves are not documents
+        if name.startswith('.') or is_ocr_sidecar(name):
+            continue
+        path = os.path.join(doc_dir, name)
+        sidecar = storage_codec.resolve(os.path.join(doc_dir, f"{name}.ocr.txt")) if needs_ocr(name) else None
+        try:
+            if sidecar is not None:
+                loaded = [Document(page_content=_read_stored_text(sidecar), metadata={"source": path})]
+            elif name in compressed_names:
+                loaded = [Document(page_content=_read_stored_text(path), metadata={"source": path})]
+            else:
+                loaded = UnstructuredFileLoader(path).load()
+        except Exception as e:
+            logger.error(f"Error loading {path}: {e}")
+            continue
+        documents.extend(loaded)
+    return documents
+
+def assign_chunk_ids(splits, source_keys):
+    """Derive stable chunk ids from each chunk's source, content and position.
+
+    Position is the ordinal of identical content within the same source, so
+    editing one paragraph leaves the ids of every other chunk unchanged.
+    """
+    seen = Counter()
+    ids = []
+    for doc in splits:
+        source = doc.metadata.get("source", "")
+        source_key = source_keys.get(os.path.basename(source), source)
+        occurrence = seen[(source_key, doc.page_content)]
+        seen[(source_key, doc.page_content)] += 1
+        digest = hashlib.sha1(f"{source_key}\0{occurrence}\0{doc.page_content}".encode("utf-8"))
+        ids.append(digest.hexdigest())
+    return ids
+
+def build_chunk_store(doc_dir, embedding_model, previous=None, source_keys=None, compressed_names=(),
+                      max_chunks=MAX_CHUNKS_PER_SESSION, on_chunked=None):
+    """Load, split and embed a session's documents into an (ids, docs, vectors) chunk store.
+
+    Only the first max_chunks chunks are indexed; on_chunked(total, indexed)
+    is called after splitting so the caller can report a truncated index.
+
+    When the previous chunk store is given, only chunks whose ids are new are
+    embedded; vectors of unchanged chunks are copied over and chunks that
+    disappeared are dropped.
+    """
+    # Load documents from the directory
+    documents = load_session_documents(doc_dir, compressed_names)
     
-    prompt = ChatPromptTemplate.from_template(template)
+    # Split documents into chunks
+    # start_index lets context packing merge overlapping neighbours
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200, add_start_index=True)
+    splits = text_splitter.split_documents(documents)
+    total_chunks = len(splits)
+    if len(splits) > max_chunks:
+        logger.warning(f"{doc_dir} produced {len(splits)} chunks, indexing the first {max_chunks}")
+        splits = splits[:max_chunks]
+    if on_chunked is not None:
+        on_chunked(total_chunks, len(splits))
+    
+    chunk_ids = assign_chunk_ids(splits, source_keys or {})
+    
+    old_rows = {}
+    if previous is not None:
+        old_ids, _, old_vectors = previous
+        old_rows = {chunk_id: row for row, chunk_id in enumerate(old_ids)}
+    
+    added_rows = [row for row, chunk_id in enumerate(chunk_ids) if chunk_id not in old_rows]
+    added_vectors = normalize_rows(
+        embedding_model.embed_documents([splits[row].page_content for row in added_rows])
+    ) if added_rows else None
+    
+    dim = added_vectors.shape[1] if added_vectors is not None else (old_vectors.shape[1] if old_rows else 0)
+    vectors = np.empty((len(chunk_ids), dim), dtype=np.float32)
+    if added_rows:
+        vectors[added_rows] = added_vectors
+    # Unchanged chunks keep their vectors; their documents (and metadata) are refreshed
+    for row, chunk_id in enumerate(chunk_ids):
+        if chunk_id in old_rows:
+            vectors[row] = old_vectors[old_rows[chunk_id]]
     
-    # Create the model
-    model = ChatGroq(model="gemma2-9b-it", api_key=groq_api_key)
+    embedded = len(added_rows)
+    reused = len(chunk_ids) - embedded
+    removed = len(old_rows.keys() - set(chunk_ids))
+    _indexing_stats["chunks_embedded"] += embedded
+    _indexing_stats["chunks_reused"] += reused
+    _indexing_stats["chunks_removed"] += removed
+    logger.info(f"Indexed {doc_dir}: {embedded} chunks embedded, {reused} reused, {removed} removed")
+    return chunk_ids, splits, vectors
+
+def get_indexing_stats():
+    """Return totals of chunks re-embedded vs. reused across index rebuilds."""
+    return dict(_indexing_stats)
+
+def format_docs(docs):
+    """Format the context from retrieved documents, merged, deduplicated and fit to the token budget."""
+    return pack_context(docs)
+
+def get_session_vectorstore(session_id):
+    """Return the session's vectorstore, or None if it has no documents."""
+    # Define the directory where uploaded files are stored for this session
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    
+    # Check if documents exist for this session
+    if not os.path.exists(doc_dir) or not any(os.scandir(doc_dir)):
+        return None
     
-    # Define a function to format the context from retrieved documents
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
+    # Re-scraped pages get a new filename, so key their chunks by URL instead
+    def build(previous):
+        manifest = read_manifest(session_id)
+        source_keys = {
+            name: entry["original_url"]
+            for name, entry in manifest["files"].items() if entry.get("original_url")
+        }
+        return build_chunk_store(
+            doc_dir, embedding_model, previous, source_keys, compressed_text_names(manifest),
+            on_chunked=lambda total, indexed: set_chunk_usage(session_id, total, indexed)
+        )
+    
+    # Load the shared on-disk index, building it only when the documents changed
+    embedding_model = get_embedding_model()
+    return index_store.get_vectorstore(session_id, doc_dir, build, embedding_model)
+
+def get_library_vectorstore():
+    """Return the shared library's vectorstore, or None if the library is empty."""
+    if not library_has_documents():
+        return None
+    embedding_model = get_embedding_model()
+    return index_store.get_vectorstore(
+        "library",
+        LIBRARY_DIR,
+        lambda previous: build_chunk_store(LIBRARY_DIR, embedding_model, previous, max_chunks=LIBRARY_MAX_CHUNKS),
+        embedding_model,
+        index_dir=LIBRARY_INDEX_DIR
+    )
+
+def get_session_indexes(session_id):
+    """Return the indexes a session retrieves from: its own and, if attached, the library's."""
+    indexes = [get_session_vectorstore(session_id)]
+    if is_library_attached(session_id):
+        indexes.append(get_library_vectorstore())
+    return [index for index in indexes if index is not None]
+
+def has_retrievable_documents(session_id):
+    """Check whether a session has its own documents or an attached, non-empty library."""
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    if os.path.exists(doc_dir) and any(os.scandir(doc_dir)):
+        return True
+    return is_library_attached(session_id) and library_has_documents()
+
+def retrieve_batch(indexes, questions, k=4):
+    """Embed all questions in one call and search each index once for all of them."""
+    embedding = get_embedding_model()
+    vectors = embedding.embed_queries(questions)
+    return [[doc for doc, _ in hits] for hits in search_merged(indexes, vectors, k)]
+
+def prepare_batch(session_id, questions, chat_history=""):
+    """Retrieve context for many questions at once; returns the (chain, inputs) to answer them.
+
+    Retrieval for all questions is done up front in one batched embedding
+    call and one index search, so its errors surface before any answer is
+    streamed.
+    """
+    indexes = get_session_indexes(session_id)
+    if not indexes:
+        logger.info(f"No documents found for session {session_id}, using general knowledge mode")
+        chain = create_general_knowledge_chain()
+        inputs = [{"question": q, "chat_history": chat_history} for q in questions]
+    else:
+        contexts = retrieve_batch(indexes, questions)
+        chain = ChatPromptTemplate.from_template(RAG_TEMPLATE) | get_llm() | StrOutputParser()
+        inputs = [
+            {"question": q, "chat_history": chat_history, "context": format_docs(docs)}
+            for q, docs in zip(questions, contexts)
+        ]
+    return chain, inputs
+
+def answer_batch(session_id, questions, batch, max_concurrency=BATCH_MAX_CONCURRENCY):
+    """Answer a prepared batch, yielding results as they complete.
+
+    LLM calls run with bounded concurrency. Each yielded dict has index,
+    question and either answer or error. Closing the generator early (e.g. on
+    client disconnect) cancels the calls that have not started.
+    """
+    chain, inputs = batch
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, BATCH_MAX_CONCURRENCY)))
+    try:
+        futures = {pool.submit(chain.invoke, item): i for i, item in enumerate(inputs)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                yield {"index": i, "question": questions[i], "answer": future.result()}
+            except Exception as e:
+                logger.error(f"Batch question {i} failed for session {session_id}: {e}")
+                yield {"index": i, "question": questions[i], "error": str(e)}
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def build_chain(session_id):
+    indexes = get_session_indexes(session_id)
+    if not indexes:
+        logger.info(f"No documents found for session {session_id}, using general knowledge mode")
+        return create_general_knowledge_chain()
+    
+    # Create a retriever, merging session and library hits when both are present
+    if len(indexes) == 1:
+        retriever = indexes[0].as_retriever()
+    else:
+        retriever = MergedRetriever(indexes=indexes, embedding=get_embedding_model())
+    
+    # Define a function to extract the question string from the input
+    def get_query(inputs):
+        if isinstance(inputs, dict) and "question" in inputs:
+            return inputs["question"]
+        elif isinstance(inputs, str):
+            return inputs
+        return str(inputs)
+    
+    prompt = ChatPromptTemplate.from_template(RAG_TEMPLATE)
+    
+    # Reuse the pooled model client
+    model = get_llm()
     
     # Create the RAG chain
     rag_chain = (
@@ -102,9 +313,28 @@ Chat History:
     
 Question: {question}
 """
+    return _create_history_only_chain(template)
+
+def create_conversation_chain():
+    """Create a chain for conversational turns in a session that may have documents.
+
+    Used for turns the query router answers without retrieval, so the prompt
+    must not tell the model that no documents exist.
+    """
+    template = """
+You are a smart, friendly, and helpful personal assistant. The user may have shared documents in this conversation, but this message is conversational (a greeting, thanks, an introduction, or a question about the conversation itself). Reply naturally using the chat history. Do not claim that no documents were provided; if the user asks about document content, say you can look it up if they ask their question.
+
+Chat History:
+{chat_history}
     
+Question: {question}
+"""
+    return _create_history_only_chain(template)
+
+def _create_history_only_chain(template):
+    """Build a prompt | model chain that sees the question and chat history but no retrieved context."""
     prompt = ChatPromptTemplate.from_template(template)
-    model = ChatGroq(model="gemma2-9b-it", api_key=groq_api_key)
+    model = get_llm()
     
     general_chain = (
         {
@@ -0,0 +1,226 @@
+"""Opt-in per-request profiling for the chat and ingestion endpoints.
+
+A request is profiled when it carries an `X-Profile: 1` header plus a
+matching `X-Admin-Token` (the header is ignored while PROFILE_ADMIN_TOKEN is
+unset) or is picked by PROFILE_SAMPLE_RATE. While it runs, a sampler thread records the Python
+stacks of all busy threads every PROFILE_INTERVAL_MS (so the work done in
+worker threads by build_chain and rag_chain.invoke is included) and
+tracemalloc tracks allocations. The result is stored as
+PROFILE_DIR/<request_id>.json and served by /profiles/<request_id>.
+
+Sampling is process-wide, so only one request is profiled at a time and
+concurrent requests may show up in its stacks. With profiling off the cost
+is one header lookup and a random draw per profiled-path request.
+"""
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "request_profiles")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+# X-Profile headers and profile retrieval require a matching X-Admin-Token;
+# while unset, only PROFILE_SAMPLE_RATE profiles requests and profiles cannot be read
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+
+PROFILED_PATHS = {"/chat", "/regenerate", "/upload", "/add_web_links"}
+
+os.makedirs(PROFILE_DIR, exist_ok=True)
+
+# Innermost frames of threads that are parked rather than working
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_active_lock = threading.Lock()
+
+_stats = {"profiled": 0, "skipped_busy": 0}
+
+def valid_request_id(request_id):
+    """Check a client-supplied request id is safe to use as a file name."""
+    return bool(request_id and _REQUEST_ID_PATTERN.match(request_id))
+
+def get_profile_path(request_id):
+    return os.path.join(PROFILE_DIR, f"{request_id}.json")
+
+def should_profile(headers):
+    """Decide whether to profile a request from its headers and the sampling rate."""
+    if headers.get("x-profile") == "1" and PROFILE_ADMIN_TOKEN and headers.get("x-admin-token") == PROFILE_ADMIN_TOKEN:
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+class _StackSampler(threading.Thread):
+    """Background thread counting the folded Python stacks of busy threads."""
+
+    def __init__(self, interval):
+        super().__init__(name="request-profiler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def start_profile(request_id, method, path):
+    """Begin profiling a request; returns a handle for finish_profile, or None if busy."""
+    if not _active_lock.acquire(blocking=False):
+        _stats["skipped_busy"] += 1
+        return None
+    try:
+        # Respect tracing started elsewhere (e.g. PYTHONTRACEMALLOC)
+        owns_tracemalloc = not tracemalloc.is_tracing()
+        if owns_tracemalloc:
+            tracemalloc.start(10)
+        tracemalloc.reset_peak()
+        sampler = _StackSampler(PROFILE_INTERVAL_MS / 1000)
+        profile = {
+            "request_id": request_id,
+            "method": method,
+            "path": path,
+            "started_at": datetime.now().isoformat(),
+            "start": time.perf_counter(),
+            "baseline": tracemalloc.take_snapshot(),
+            "owns_tracemalloc": owns_tracemalloc,
+            "sampler": sampler
+        }
+        sampler.start()
+        return profile
+    except Exception:
+        _active_lock.release()
+        raise
+
+def _summarize_stacks(stacks):
+    """Top functions by self and inclusive sample counts."""
+    self_counts = Counter()
+    total_counts = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] += count
+        for frame in set(frames):
+            total_counts[frame] += count
+    return (
+        [{"frame": frame, "samples": count} for frame, count in self_counts.most_common(PROFILE_TOP_N)],
+        [{"frame": frame, "samples": count} for frame, count in total_counts.most_common(PROFILE_TOP_N)]
+    )
+
+def finish_profile(profile, status_code):
+    """Stop profiling, store the profile and return its summary."""
+    try:
+        profile["sampler"].stop()
+        duration_ms = 1000 * (time.perf_counter() - profile["start"])
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if profile["owns_tracemalloc"]:
+            tracemalloc.stop()
+    finally:
+        _active_lock.release()
+
+    sampler = profile["sampler"]
+    top_self, top_total = _summarize_stacks(sampler.stacks)
+    allocation_stats = snapshot.compare_to(profile["baseline"], "lineno")
+    allocations = [
+        {"location": str(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+        for stat in allocation_stats[:PROFILE_TOP_N]
+    ]
+    result = {
+        "request_id": profile["request_id"],
+        "method": profile["method"],
+        "path": profile["path"],
+        "status_code": status_code,
+        "started_at": profile["started_at"],
+        "duration_ms": round(duration_ms, 2),
+        "cpu": {
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "samples": sampler.samples,
+            "top_self": top_self,
+            "top_inclusive": top_total,
+            # Folded stacks, as consumed by flamegraph.pl and speedscope
+            "folded": dict(sampler.stacks.most_common())
+        },
+        "allocations": {
+            "peak_bytes": peak,
+            "net_bytes": sum(stat.size_diff for stat in allocation_stats),
+            "top": allocations
+        }
+    }
+
+    with open(get_profile_path(profile["request_id"]), "w") as f:
+        json.dump(result, f)
+    _stats["profiled"] += 1
+    _prune()
+    logger.info(f"Profiled {profile['method']} {profile['path']} as {profile['request_id']} ({duration_ms:.0f}ms)")
+    return result
+
+def _prune():
+    """Keep only the newest PROFILE_KEEP profiles."""
+    entries = sorted(
+        (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(".json")),
+        key=lambda entry: entry.stat().st_mtime
+    )
+    for entry in entries[:-PROFILE_KEEP]:
+        os.remove(entry.path)
+
+def read_profile(request_id):
+    """Return a stored profile, or None if there is none for the request id."""
+    path = get_profile_path(request_id)
+    if not valid_request_id(request_id) or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def list_profiles():
+    """Summaries of stored profiles, newest first."""
+    profiles = []
+    for entry in os.scandir(PROFILE_DIR):
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            with open(entry.path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"Skipping unreadable profile {entry.name}: {e}")
+            continue
+        profiles.append({key: data.get(key) for key in ("request_id", "method", "path", "status_code", "started_at", "duration_ms")})
+    profiles.sort(key=lambda p: p.get("started_at") or "", reverse=True)
+    return profiles
+
+def get_profiler_stats():
+    """Return how many requests were profiled or skipped because another was running."""
+    return dict(_stats, sample_rate=PROFILE_SAMPLE_RATE)
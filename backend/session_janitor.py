@@ -0,0 +1,241 @@
+"""Background cleanup of idle and abandoned sessions, plus per-session quotas.
+
+The janitor periodically:
+  * evicts in-memory state (mapped indexes) for sessions idle longer than
+    SESSION_IDLE_TTL seconds, and
+  * archives or deletes on-disk sessions untouched for SESSION_RETENTION_DAYS,
+    according to SESSION_STALE_POLICY (archive, delete or keep).
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+from datetime import datetime
+import index_store
+import storage_codec
+from file_manifest import get_manifest_path, get_manifest_lock_path
+from memory_store import (
+    MEMORY_DIR, SESSION_SIDECAR_SUFFIXES, get_memory_path, get_metadata_path, get_patch_log_path,
+    get_history_lock_path
+)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploaded_docs"
+ARCHIVE_DIR = os.getenv("SESSION_ARCHIVE_DIR", "session_archive")
+
+JANITOR_INTERVAL = float(os.getenv("JANITOR_INTERVAL", "300"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "1800"))
+SESSION_RETENTION_DAYS = float(os.getenv("SESSION_RETENTION_DAYS", "30"))
+SESSION_STALE_POLICY = os.getenv("SESSION_STALE_POLICY", "archive")
+
+MAX_FILES_PER_SESSION = int(os.getenv("MAX_FILES_PER_SESSION", "50"))
+MAX_SESSION_BYTES = int(os.getenv("MAX_SESSION_BYTES", str(100 * 1024 * 1024)))
+MAX_CHUNKS_PER_SESSION = int(os.getenv("MAX_CHUNKS_PER_SESSION", "5000"))
+
+# session_id -> last time this process served a request for it
+_last_seen = {}
+_last_seen_lock = threading.Lock()
+
+_stats = {
+    "sweeps": 0,
+    "evicted_sessions": 0,
+    "archived_sessions": 0,
+    "deleted_sessions": 0,
+    "reclaimed_bytes": 0,
+    "last_sweep": None
+}
+
+def touch_session(session_id):
+    """Record activity for a session so it is not treated as idle."""
+    with _last_seen_lock:
+        _last_seen[session_id] = time.time()
+
+def _session_paths(session_id):
+    """All on-disk paths that belong to a session (index excluded)."""
+    return [
+        os.path.join(UPLOAD_DIR, session_id),
+        *storage_codec.variants(get_memory_path(session_id)),
+        get_patch_log_path(session_id),
+        get_history_lock_path(session_id),
+        get_metadata_path(session_id),
+        get_manifest_path(session_id),
+        get_manifest_lock_path(session_id)
+    ]
+
+def _path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _last_modified(session_id):
+    latest = 0.0
+    for path in _session_paths(session_id):
+        if not os.path.exists(path):
+            continue
+        latest = max(latest, os.path.getmtime(path))
+        if os.path.isdir(path):
+            for entry in os.scandir(path):
+                latest = max(latest, entry.stat().st_mtime)
+    return latest
+
+def get_session_usage(session_id):
+    """Return (file_count, total_bytes) of a session's uploaded documents."""
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    if not os.path.exists(doc_dir):
+        return 0, 0
+    count, total = 0, 0
+    for entry in os.scandir(doc_dir):
+        if entry.is_file() and not storage_codec.strip_codec_suffix(entry.name).endswith('.ocr.txt'):
+            count += 1
+            total += entry.stat().st_size
+    return count, total
+
+def check_quota(session_id, filename, size):
+    """Return None if adding a file fits the session quota, else the reason it does not."""
+    count, total = get_session_usage(session_id)
+    existing = os.path.join(UPLOAD_DIR, session_id, filename)
+    if os.path.exists(existing):
+        # Replacing a file frees its old slot and bytes
+        count -= 1
+        total -= os.path.getsize(existing)
+    if count + 1 > MAX_FILES_PER_SESSION:
+        return f"session file limit ({MAX_FILES_PER_SESSION}) reached"
+    if total + size > MAX_SESSION_BYTES:
+        return f"session storage limit ({MAX_SESSION_BYTES // (1024 * 1024)}MB) reached"
+    return None
+
+def purge_session(session_id):
+    """Delete all on-disk data for a session; returns the number of bytes freed."""
+    freed = 0
+    for path in _session_paths(session_id) + [index_store.get_session_index_dir(session_id)]:
+        try:
+            if not os.path.exists(path):
+                continue
+            size = _path_size(path)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            freed += size
+        except Exception as e:
+            logger.warning(f"Error deleting {path} for session {session_id}: {e}")
+    index_store.evict(session_id)
+    with _last_seen_lock:
+        _last_seen.pop(session_id, None)
+    return freed
+
+def archive_session(session_id):
+    """Bundle a session's documents and history into a tarball, then purge it."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d%H%M%S')
+    archive_path = os.path.join(ARCHIVE_DIR, f"{session_id}_{stamp}.tar.gz")
+    with tarfile.open(archive_path, "w:gz") as tar:
+        for path in _session_paths(session_id):
+            if os.path.exists(path):
+                tar.add(path)
+    freed = purge_session(session_id)
+    return freed - os.path.getsize(archive_path)
+
+def _known_session_ids():
+    session_ids = set()
+    if os.path.exists(UPLOAD_DIR):
+        session_ids.update(entry.name for entry in os.scandir(UPLOAD_DIR) if entry.is_dir())
+    for name in os.listdir(MEMORY_DIR):
+        name = storage_codec.strip_codec_suffix(name)
+        for suffix in SESSION_SIDECAR_SUFFIXES + (".json",):
+            if name.endswith(suffix):
+                session_ids.add(name[:-len(suffix)])
+                break
+    return session_ids
+
+def evict_idle_sessions(now=None):
+    """Drop in-memory state for sessions idle longer than SESSION_IDLE_TTL."""
+    now = now or time.time()
+    with _last_seen_lock:
+        idle = [sid for sid, seen in _last_seen.items() if now - seen > SESSION_IDLE_TTL]
+        for session_id in idle:
+            del _last_seen[session_id]
+    for session_id in idle:
+        index_store.evict(session_id)
+    return len(idle)
+
+def sweep_stale_sessions(now=None):
+    """Archive or delete sessions untouched for SESSION_RETENTION_DAYS."""
+    report = {"archived": 0, "deleted": 0, "reclaimed_bytes": 0}
+    if SESSION_STALE_POLICY not in ("archive", "delete"):
+        return report
+
+    now = now or time.time()
+    cutoff = now - SESSION_RETENTION_DAYS * 86400
+
+    # Only one worker per host sweeps the shared directories at a time
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, ".janitor.lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return report
+        try:
+            with _last_seen_lock:
+                active = set(_last_seen)
+            for session_id in _known_session_ids() - active:
+                try:
+                    if _last_modified(session_id) >= cutoff:
+                        continue
+                    if SESSION_STALE_POLICY == "archive":
+                        report["reclaimed_bytes"] += archive_session(session_id)
+                        report["archived"] += 1
+                    else:
+                        report["reclaimed_bytes"] += purge_session(session_id)
+                        report["deleted"] += 1
+                    logger.info(f"Janitor {SESSION_STALE_POLICY}d stale session {session_id}")
+                except Exception as e:
+                    logger.error(f"Janitor failed on session {session_id}: {e}")
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return report
+
+def run_sweep():
+    """Run one janitor pass and fold its results into the running totals."""
+    evicted = evict_idle_sessions()
+    report = sweep_stale_sessions()
+    _stats["sweeps"] += 1
+    _stats["evicted_sessions"] += evicted
+    _stats["archived_sessions"] += report["archived"]
+    _stats["deleted_sessions"] += report["deleted"]
+    _stats["reclaimed_bytes"] += report["reclaimed_bytes"]
+    _stats["last_sweep"] = datetime.now().isoformat()
+    if evicted or report["archived"] or report["deleted"]:
+        logger.info(
+            f"Janitor evicted {evicted} idle sessions, archived {report['archived']}, "
+            f"deleted {report['deleted']}, reclaimed {report['reclaimed_bytes']} bytes"
+        )
+    return report
+
+async def run_janitor():
+    """Background loop started from the application lifespan."""
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        try:
+            await asyncio.to_thread(run_sweep)
+        except Exception as e:
+            logger.error(f"Janitor sweep failed: {e}")
+
+def get_janitor_stats():
+    """Return cumulative janitor counters."""
+    with _last_seen_lock:
+        active = len(_last_seen)
+    return dict(_stats, active_sessions=active)
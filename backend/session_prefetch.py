@@ -0,0 +1,128 @@
+"""Speculative warm-up of a session's index and chain when it is opened.
+
+The frontend reads /chat_history and /uploaded_files as soon as a session is
+opened, well before the first message. Those endpoints call
+schedule_prefetch, which runs the same (singleflight-coalesced) chain build
+that /chat performs, in the background, so the first message finds the index
+already mapped. A /chat arriving mid-warm-up joins the in-flight build.
+
+Speculative warm-ups are bounded by PREFETCH_MEMORY_BUDGET_MB of index data
+held for sessions that have not sent a message yet; a session that is not
+used within PREFETCH_TIMEOUT seconds has its warmed index evicted again, and
+is not warmed speculatively again for PREFETCH_COOLDOWN seconds unless it
+sends a message, so an idle open tab does not keep reloading it.
+"""
+import asyncio
+import logging
+import os
+import time
+import index_store
+from rag_chain import UPLOAD_DIR, has_retrievable_documents
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+PREFETCH_MEMORY_BUDGET = int(os.getenv("PREFETCH_MEMORY_BUDGET_MB", "512")) * 1024 * 1024
+PREFETCH_TIMEOUT = float(os.getenv("PREFETCH_TIMEOUT", "300"))
+PREFETCH_COOLDOWN = float(os.getenv("PREFETCH_COOLDOWN", "3600"))
+
+# session_id -> {"bytes": reserved budget, "task": warm-up task}, until used or expired
+_pending = {}
+# session_id -> time its unused warm-up was evicted
+_expired = {}
+
+_stats = {
+    "scheduled": 0,
+    "completed": 0,
+    "failed": 0,
+    "used": 0,
+    "expired": 0,
+    "skipped_budget": 0,
+    "skipped_cooldown": 0
+}
+
+def _estimate_bytes(session_id):
+    """Index bytes a warm-up will map: the stored generation, else the raw documents as a bound."""
+    size = index_store.stored_size(session_id)
+    if size:
+        return size
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    if not os.path.isdir(doc_dir):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(doc_dir) if entry.is_file())
+
+def schedule_prefetch(session_id, warm):
+    """Warm a session in the background unless it is warm, warming or over budget.
+
+    warm is a coroutine function performing the chain build. Returns True if
+    a warm-up was started.
+    """
+    if not PREFETCH_ENABLED or session_id in _pending or index_store.is_loaded(session_id):
+        return False
+    expired_at = _expired.get(session_id)
+    if expired_at is not None:
+        if time.monotonic() - expired_at < PREFETCH_COOLDOWN:
+            _stats["skipped_cooldown"] += 1
+            return False
+        del _expired[session_id]
+    if not has_retrievable_documents(session_id):
+        return False
+
+    size = _estimate_bytes(session_id)
+    reserved = sum(entry["bytes"] for entry in _pending.values())
+    if reserved + size > PREFETCH_MEMORY_BUDGET:
+        _stats["skipped_budget"] += 1
+        logger.info(f"Skipping prefetch of session {session_id}: memory budget exhausted")
+        return False
+
+    _stats["scheduled"] += 1
+    entry = {"bytes": size}
+    _pending[session_id] = entry
+    entry["task"] = asyncio.create_task(_run(session_id, warm))
+    return True
+
+async def _run(session_id, warm):
+    started = time.monotonic()
+    try:
+        await warm()
+    except Exception as e:
+        _stats["failed"] += 1
+        _pending.pop(session_id, None)
+        logger.warning(f"Prefetch of session {session_id} failed: {e}")
+        return
+    _stats["completed"] += 1
+    logger.info(f"Prefetched session {session_id} in {time.monotonic() - started:.2f}s")
+
+    # claim_prefetch cancels this task if the session is used in time
+    await asyncio.sleep(max(0.0, PREFETCH_TIMEOUT - (time.monotonic() - started)))
+    if _pending.pop(session_id, None) is not None:
+        index_store.evict(session_id)
+        _expired[session_id] = time.monotonic()
+        _stats["expired"] += 1
+        logger.info(f"Evicted prefetched session {session_id}: unused after {PREFETCH_TIMEOUT:.0f}s")
+
+def claim_prefetch(session_id):
+    """Keep a prefetched session's warm state now that it is in use; True on a prefetch hit."""
+    _expired.pop(session_id, None)
+    entry = _pending.pop(session_id, None)
+    if entry is None:
+        return False
+    # The build itself is shielded by the singleflight, so /chat can still join it
+    entry["task"].cancel()
+    _stats["used"] += 1
+    return True
+
+def cancel_prefetches():
+    """Cancel all pending warm-ups (on shutdown)."""
+    for entry in _pending.values():
+        entry["task"].cancel()
+    _pending.clear()
+
+def get_prefetch_stats():
+    """Return warm-up counters and the budget currently reserved by unused sessions."""
+    stats = dict(_stats)
+    stats["pending"] = len(_pending)
+    stats["reserved_bytes"] = sum(entry["bytes"] for entry in _pending.values())
+    stats["budget_bytes"] = PREFETCH_MEMORY_BUDGET
+    return stats
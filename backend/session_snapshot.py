@@ -0,0 +1,234 @@
+"""Export and import a whole session as one versioned archive.
+
+A snapshot is a gzipped tarball laid out as:
+
+    snapshot.json       format version, session id, embedding id, file checksums
+    docs/<name>         raw uploads, scraped pages and OCR text sidecars
+    memory/history.json chat history with journaled patches applied
+    memory/metadata.json, memory/files.json   session metadata and file manifest
+    index/<name>        the published index generation (chunks.json, embeddings.npy)
+
+Importing a snapshot whose index was current when exported, on a node using
+the same embedding model, publishes that index directly, so the restored
+session answers its first question without parsing or embedding anything.
+The archive is untrusted input, so only the JSON chunks and the plain NumPy
+vectors are restored, after validation, and the FAISS index is rebuilt from
+them. Otherwise the index is rebuilt lazily on first use, as for any session.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+from datetime import datetime
+import index_store
+import storage_codec
+from embeddings import get_embedding_id
+from file_manifest import get_manifest_path
+from memory_store import get_memory, get_memory_path, get_metadata_path
+from rag_chain import get_session_vectorstore
+from session_janitor import MAX_FILES_PER_SESSION, MAX_SESSION_BYTES, purge_session
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploaded_docs"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "session_snapshots")
+SNAPSHOT_FORMAT_VERSION = 1
+# Unpacked size limits for the non-document parts of an imported snapshot
+SNAPSHOT_MAX_MEMORY_BYTES = int(os.getenv("SNAPSHOT_MAX_MEMORY_BYTES", str(64 * 1024 * 1024)))
+SNAPSHOT_MAX_INDEX_BYTES = int(os.getenv("SNAPSHOT_MAX_INDEX_BYTES", str(512 * 1024 * 1024)))
+
+os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _add_bytes(tar, arcname, data):
+    info = tarfile.TarInfo(arcname)
+    info.size = len(data)
+    info.mtime = int(datetime.now().timestamp())
+    tar.addfile(info, io.BytesIO(data))
+
+def session_exists(session_id):
+    """Check whether any documents, history or metadata are stored for a session."""
+    return (
+        os.path.exists(os.path.join(UPLOAD_DIR, session_id))
+        or storage_codec.exists(get_memory_path(session_id))
+        or os.path.exists(get_metadata_path(session_id))
+    )
+
+def export_session(session_id):
+    """Write a snapshot of a session and return the archive path.
+
+    The caller owns the returned file and should delete it once sent.
+    """
+    if not session_exists(session_id):
+        raise FileNotFoundError(session_id)
+
+    doc_dir = os.path.join(UPLOAD_DIR, session_id)
+    doc_names = []
+    if os.path.isdir(doc_dir):
+        doc_names = sorted(
+            entry.name for entry in os.scandir(doc_dir)
+            if entry.is_file() and not entry.name.startswith('.')
+        )
+        # Bring the index up to date so the snapshot carries it warm
+        if doc_names:
+            get_session_vectorstore(session_id)
+
+    fd, archive_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, prefix=".export-", suffix=".tar.gz")
+    os.close(fd)
+    try:
+        with tarfile.open(archive_path, "w:gz") as tar, index_store.current_generation(session_id) as current:
+            generation_dir, fingerprint, embedding_id = current
+            files = {name: {
+                "size": os.path.getsize(os.path.join(doc_dir, name)),
+                "sha256": _file_sha256(os.path.join(doc_dir, name))
+            } for name in doc_names}
+            index_current = (
+                generation_dir is not None and bool(doc_names)
+                and fingerprint == index_store.index_fingerprint(doc_dir, embedding_id)
+            )
+            snapshot = {
+                "format_version": SNAPSHOT_FORMAT_VERSION,
+                "session_id": session_id,
+                "exported_at": datetime.now().isoformat(),
+                "embedding_id": embedding_id,
+                "index_current": index_current,
+                "files": files
+            }
+            # First member, so importers can reject an archive before unpacking it
+            _add_bytes(tar, "snapshot.json", json.dumps(snapshot, indent=2).encode("utf-8"))
+
+            for name in doc_names:
+                tar.add(os.path.join(doc_dir, name), arcname=f"docs/{name}")
+
+            _add_bytes(tar, "memory/history.json", json.dumps(get_memory(session_id)).encode("utf-8"))
+            for path, arcname in ((get_metadata_path(session_id), "memory/metadata.json"),
+                                  (get_manifest_path(session_id), "memory/files.json")):
+                if os.path.exists(path):
+                    tar.add(path, arcname=arcname)
+
+            if index_current:
+                # index.faiss is rebuilt on import, so only the chunk store is shipped
+                for name in ("chunks.json", "embeddings.npy"):
+                    tar.add(os.path.join(generation_dir, name), arcname=f"index/{name}")
+    except Exception:
+        os.remove(archive_path)
+        raise
+
+    logger.info(f"Exported session {session_id} ({len(doc_names)} files, index {'included' if index_current else 'omitted'})")
+    return archive_path
+
+def _safe_members(tar):
+    """Yield (member, section, name) for the regular files of a snapshot, rejecting anything else."""
+    for member in tar.getmembers():
+        section, _, name = member.name.partition("/")
+        if member.name == "snapshot.json":
+            continue
+        if (not member.isfile() or section not in ("docs", "memory", "index")
+                or not name or name != os.path.basename(name) or name.startswith('.')):
+            raise ValueError(f"Unexpected archive member: {member.name}")
+        yield member, section, name
+
+def import_session(archive_path, session_id=None, overwrite=False):
+    """Restore a session from a snapshot archive.
+
+    session_id defaults to the exported session's id; an existing session
+    with that id is replaced only when overwrite is set. Returns a summary
+    with the session id, file count and whether the index was restored.
+    """
+    staging = tempfile.mkdtemp(dir=SNAPSHOT_DIR, prefix=".import-")
+    try:
+        with tarfile.open(archive_path, "r:*") as tar:
+            try:
+                snapshot = json.load(tar.extractfile("snapshot.json"))
+            except KeyError:
+                raise ValueError("Not a session snapshot: snapshot.json missing")
+            if snapshot.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+                raise ValueError(f"Unsupported snapshot format version: {snapshot.get('format_version')}")
+
+            files = snapshot.get("files", {})
+            if len(files) > MAX_FILES_PER_SESSION:
+                raise ValueError(f"session file limit ({MAX_FILES_PER_SESSION}) exceeded")
+            if sum(info["size"] for info in files.values()) > MAX_SESSION_BYTES:
+                raise ValueError(f"session storage limit ({MAX_SESSION_BYTES // (1024 * 1024)}MB) exceeded")
+
+            # Check declared sizes before writing anything, so a small, highly
+            # compressible archive cannot unpack into an arbitrarily large one
+            limits = {
+                "docs": sum(info["size"] for info in files.values()),
+                "memory": SNAPSHOT_MAX_MEMORY_BYTES,
+                "index": SNAPSHOT_MAX_INDEX_BYTES
+            }
+            unpacked = {section: 0 for section in limits}
+            for member, section, name in _safe_members(tar):
+                if section == "docs":
+                    if name not in files:
+                        raise ValueError(f"Unlisted document in archive: {name}")
+                    if member.size != files[name]["size"]:
+                        raise ValueError(f"Size mismatch for {name}")
+                unpacked[section] += member.size
+                if unpacked[section] > limits[section]:
+                    raise ValueError(f"Snapshot {section} section exceeds {limits[section]} bytes")
+                target_dir = os.path.join(staging, section)
+                os.makedirs(target_dir, exist_ok=True)
+                with tar.extractfile(member) as src, open(os.path.join(target_dir, name), "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+
+        staged_docs = os.path.join(staging, "docs")
+        for name, info in files.items():
+            path = os.path.join(staged_docs, name)
+            if not os.path.exists(path) or _file_sha256(path) != info["sha256"]:
+                raise ValueError(f"Checksum mismatch for {name}")
+
+        session_id = session_id or snapshot["session_id"]
+        if not session_id or session_id != os.path.basename(session_id) or session_id.startswith('.'):
+            raise ValueError(f"Invalid session ID: {session_id}")
+        if session_exists(session_id):
+            if not overwrite:
+                raise FileExistsError(session_id)
+            purge_session(session_id)
+
+        doc_dir = os.path.join(UPLOAD_DIR, session_id)
+        if os.path.isdir(staged_docs):
+            shutil.move(staged_docs, doc_dir)
+
+        staged_memory = os.path.join(staging, "memory")
+        history_path = os.path.join(staged_memory, "history.json")
+        if os.path.exists(history_path):
+            with open(history_path, "r", encoding="utf-8") as f:
+                storage_codec.write_text(get_memory_path(session_id), f.read())
+        for name, path in (("metadata.json", get_metadata_path(session_id)),
+                           ("files.json", get_manifest_path(session_id))):
+            if os.path.exists(os.path.join(staged_memory, name)):
+                shutil.move(os.path.join(staged_memory, name), path)
+
+        # A stored index is only valid for the documents and model it was built from
+        index_restored = False
+        staged_index = os.path.join(staging, "index")
+        embedding_id = snapshot.get("embedding_id")
+        if snapshot.get("index_current") and os.path.isdir(staged_index) and os.path.isdir(doc_dir):
+            if embedding_id == get_embedding_id():
+                try:
+                    index_store.import_generation(
+                        session_id, staged_index, index_store.index_fingerprint(doc_dir, embedding_id), embedding_id
+                    )
+                    index_restored = True
+                except ValueError as e:
+                    logger.warning(f"Not restoring snapshot index for session {session_id}: {e}")
+            else:
+                logger.info(f"Snapshot index built with {embedding_id}; session {session_id} will be re-indexed")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    logger.info(f"Imported session {session_id} ({len(files)} files, index {'restored' if index_restored else 'not restored'})")
+    return {"session_id": session_id, "files": len(files), "index_restored": index_restored}
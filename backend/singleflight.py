@@ -0,0 +1,58 @@
+import asyncio
+import logging
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one in-flight computation.
+
+    The first caller for a key runs the function in a worker thread; callers
+    arriving while it is still running await the same result instead of
+    repeating the work. Nothing is cached once the computation finishes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._inflight = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced = 0
+
+    async def run(self, key, func, *args, **kwargs):
+        """Run func(*args, **kwargs) once per key; returns (result, shared).
+
+        `shared` is True when the caller joined a computation started by
+        another request, so callers can skip side effects the leader performs.
+        """
+        self.calls += 1
+        task = self._inflight.get(key)
+        shared = task is not None
+
+        if shared:
+            self.coalesced += 1
+            logger.info(f"[{self.name}] joining in-flight computation for {key[:2]}")
+        else:
+            self.executions += 1
+            task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+
+        # Shield so one caller timing out or disconnecting does not cancel
+        # the computation the other callers are waiting on
+        result = await asyncio.shield(task)
+        return result, shared
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def stats(self):
+        """Return counters describing how much duplicate work was avoided."""
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+            "saved_ratio": round(self.coalesced / self.calls, 4) if self.calls else 0.0
+        }
@@ -0,0 +1,206 @@
+"""Transparent compression for chat history, scraped pages and cached text.
+
+Files are written as <path>.zst (zstandard, optionally with a shared trained
+dictionary) or <path>.gz when zstandard is not installed. Readers accept any
+variant, decompress in a streaming fashion, and rewrite plain text files in
+compressed form the first time they are read (JSON files on their next
+write), so existing data migrates automatically. User uploads are never migrated: the document loader reads
+the exact stored file with open_stored_text, and only for files the manifest
+says this app compressed.
+
+Train a dictionary from existing data with:
+
+    python storage_codec.py train session_memory uploaded_docs
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import threading
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# zstd, gzip or none
+STORAGE_COMPRESSION = os.getenv("STORAGE_COMPRESSION", "zstd" if zstd else "gzip")
+STORAGE_COMPRESSION_LEVEL = int(os.getenv("STORAGE_COMPRESSION_LEVEL", "6"))
+STORAGE_DICT_DIR = os.getenv("STORAGE_DICT_DIR", "storage_dict")
+
+SUFFIXES = (".zst", ".gz")
+
+_stats = {"files_written": 0, "raw_bytes": 0, "stored_bytes": 0, "migrated_files": 0, "migrated_bytes_saved": 0}
+_dicts = {}
+_dict_lock = threading.Lock()
+
+def _suffix():
+    if STORAGE_COMPRESSION == "zstd" and zstd is not None:
+        return ".zst"
+    if STORAGE_COMPRESSION in ("zstd", "gzip"):
+        return ".gz"
+    return ""
+
+def strip_codec_suffix(name):
+    """Return a file name without its compression suffix."""
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def variants(path):
+    """All on-disk names a logical file may be stored under."""
+    return [path] + [path + suffix for suffix in SUFFIXES]
+
+def resolve(path):
+    """Return the existing on-disk path for a logical file, or None."""
+    for candidate in variants(path):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def exists(path):
+    return resolve(path) is not None
+
+def remove(path):
+    """Delete every stored variant of a logical file."""
+    for candidate in variants(path):
+        if os.path.exists(candidate):
+            os.remove(candidate)
+
+def _load_dictionaries():
+    """Load trained dictionaries keyed by dict id; returns the newest one for writing."""
+    if zstd is None or not os.path.isdir(STORAGE_DICT_DIR):
+        return None
+    newest = None
+    with _dict_lock:
+        for name in sorted(os.listdir(STORAGE_DICT_DIR)):
+            if not name.endswith(".dict"):
+                continue
+            dict_path = os.path.join(STORAGE_DICT_DIR, name)
+            dict_id = int(name[:-5])
+            if dict_id not in _dicts:
+                with open(dict_path, "rb") as f:
+                    _dicts[dict_id] = zstd.ZstdCompressionDict(f.read())
+            if newest is None or os.path.getmtime(dict_path) > newest[0]:
+                newest = (os.path.getmtime(dict_path), _dicts[dict_id])
+    return newest[1] if newest else None
+
+def _compress(data):
+    suffix = _suffix()
+    if suffix == ".zst":
+        dictionary = _load_dictionaries()
+        return zstd.ZstdCompressor(level=STORAGE_COMPRESSION_LEVEL, dict_data=dictionary).compress(data)
+    if suffix == ".gz":
+        return gzip.compress(data, compresslevel=STORAGE_COMPRESSION_LEVEL)
+    return data
+
+def write_text(path, text):
+    """Atomically write a logical text file in the configured format; returns the stored path."""
+    raw = text.encode("utf-8")
+    stored = _compress(raw)
+    target = path + _suffix()
+    tmp_path = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(stored)
+    os.replace(tmp_path, target)
+    # Drop copies in other formats so readers never see stale data
+    for candidate in variants(path):
+        if candidate != target and os.path.exists(candidate):
+            os.remove(candidate)
+    _stats["files_written"] += 1
+    _stats["raw_bytes"] += len(raw)
+    _stats["stored_bytes"] += len(stored)
+    return target
+
+def open_text(path):
+    """Open a logical text file for streaming reads, whatever format it is stored in."""
+    stored = resolve(path)
+    if stored is None:
+        raise FileNotFoundError(path)
+    return open_stored_text(stored)
+
+def open_stored_text(stored):
+    """Open one specific on-disk file for streaming reads, decoding it by its suffix."""
+    if stored.endswith(".zst"):
+        if zstd is None:
+            raise RuntimeError(f"zstandard is required to read {stored}")
+        fh = open(stored, "rb")
+        params = zstd.get_frame_parameters(fh.read(18))
+        fh.seek(0)
+        if params.dict_id and params.dict_id not in _dicts:
+            _load_dictionaries()
+        dctx = zstd.ZstdDecompressor(dict_data=_dicts.get(params.dict_id) if params.dict_id else None)
+        return io.TextIOWrapper(dctx.stream_reader(fh, closefd=True), encoding="utf-8")
+    if stored.endswith(".gz"):
+        return gzip.open(stored, "rt", encoding="utf-8")
+    return open(stored, "r", encoding="utf-8")
+
+def _migrate(path, text):
+    """Rewrite a plain file in compressed form after it has been read."""
+    if not _suffix() or resolve(path) != path:
+        return
+    plain_size = os.path.getsize(path)
+    stored = write_text(path, text)
+    _stats["migrated_files"] += 1
+    _stats["migrated_bytes_saved"] += plain_size - os.path.getsize(stored)
+
+def read_text(path):
+    """Read a logical text file, migrating a plain copy to compressed storage."""
+    with open_text(path) as f:
+        text = f.read()
+    _migrate(path, text)
+    return text
+
+def load_json(path):
+    """Parse a logical JSON file straight from the decompressing stream.
+
+    Unlike read_text this never migrates: JSON files (chat history) are read
+    without their writers' lock, so a plain copy is only compressed the next
+    time its owner rewrites it.
+    """
+    with open_text(path) as f:
+        return json.load(f)
+
+def train_dictionary(sample_dirs, dict_size=112640):
+    """Train a zstd dictionary from files under the given directories and store it."""
+    if zstd is None:
+        raise RuntimeError("zstandard is not installed")
+    samples = []
+    for sample_dir in sample_dirs:
+        for root, _, files in os.walk(sample_dir):
+            for name in files:
+                if name.startswith('.') or name.endswith('.lock'):
+                    continue
+                try:
+                    with open_text(os.path.join(root, strip_codec_suffix(name))) as f:
+                        samples.append(f.read().encode("utf-8"))
+                except Exception:
+                    continue
+    if not samples:
+        raise ValueError("No samples found")
+    dictionary = zstd.train_dictionary(dict_size, samples)
+    os.makedirs(STORAGE_DICT_DIR, exist_ok=True)
+    dict_path = os.path.join(STORAGE_DICT_DIR, f"{dictionary.dict_id()}.dict")
+    with open(dict_path, "wb") as f:
+        f.write(dictionary.as_bytes())
+    logger.info(f"Trained dictionary {dictionary.dict_id()} from {len(samples)} samples")
+    return dict_path
+
+def get_storage_stats():
+    """Return bytes written before and after compression and migration savings."""
+    stats = dict(_stats, compression=_suffix().lstrip(".") or "none")
+    stats["saved_bytes"] = stats["raw_bytes"] - stats["stored_bytes"]
+    return stats
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "train":
+        print(__doc__)
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    print(train_dictionary(sys.argv[2:]))